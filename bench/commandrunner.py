@@ -0,0 +1,65 @@
+""" Times the command runner of shellcommand: a git command through
+shell() and run(), and shell() on an output with many blank lines.
+
+Run it against another checkout with --tree to compare, for example
+with the tree before the argv runner:
+
+    git worktree add /tmp/gitnetics-before 137aa35^
+    python bench/commandrunner.py --tree /tmp/gitnetics-before
+    python bench/commandrunner.py
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def make_repository(directory, commits):
+    subprocess.check_call(['git', 'init', '-q', directory])
+    for index in range(commits):
+        with open(os.path.join(directory, 'file%d' % (index % 7)), 'w') as changed:
+            changed.write('%d\n' % index)
+        subprocess.check_call(['git', 'add', '-A'], cwd=directory)
+        subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'change %d' % index], cwd=directory)
+
+
+def timed(function, calls):
+    start = time.time()
+    for call in range(calls):
+        function()
+    return (time.time() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='command runner benchmark')
+    parser.add_argument('--tree', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'), help='gitnetics tree to measure')
+    parser.add_argument('--commits', type=int, default=300, help='commits in the test repository')
+    parser.add_argument('--calls', type=int, default=200, help='git calls to time')
+    parser.add_argument('--lines', type=int, default=20000, help='non blank lines in the long output, as many blank ones')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.tree))
+    from core.colorlog import log
+    from core.repotypes import shellcommand
+    log.setLevel(logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix='gitnetics-bench-')
+    try:
+        make_repository(directory, args.commits)
+        print "shell('git rev-parse HEAD'): %.1fms per call" % (timed(lambda: shellcommand.shell('git rev-parse HEAD', cwd=directory), args.calls) * 1000)
+        if hasattr(shellcommand, 'run'):
+            print "run(['git', 'rev-parse', 'HEAD']): %.1fms per call" % (timed(lambda: shellcommand.run(['git', 'rev-parse', 'HEAD'], cwd=directory), args.calls) * 1000)
+        else:
+            print "run(): not in this tree"
+        command = "awk 'BEGIN { for (i = 0; i < %d; i++) { print \"x\"; print \"\" } }'" % args.lines
+        print "shell() on %d lines, half blank: %.3fs" % (args.lines * 2, timed(lambda: shellcommand.shell(command), 1))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" Times Git.read_commits on a generated interval against the per-commit
+path it replaced, which ran rev-list and then two git show per commit,
+recursing on the second parent of merges. Both must return the same
+commits.
+
+    python bench/readcommits.py
+    python bench/readcommits.py --commits 1000
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def git(directory, *args):
+    subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost'] + list(args), cwd=directory)
+
+
+def make_repository(directory, commits):
+    """ commits on master after a base branch, with a merge of a side
+    branch at the end """
+    git(directory, 'init', '-q', '.')
+    git(directory, 'commit', '-q', '--allow-empty', '-m', 'root')
+    git(directory, 'branch', 'base')
+    for index in range(commits):
+        git(directory, 'commit', '-q', '--allow-empty', '-m', 'change %d\n\nbody line\n\nChange-Id: I%040d' % (index, index))
+    git(directory, 'checkout', '-q', '-b', 'side', 'base')
+    git(directory, 'commit', '-q', '--allow-empty', '-m', 'side\n\nChange-Id: Iside')
+    git(directory, 'checkout', '-q', 'master')
+    git(directory, 'merge', '-q', '--no-ff', '-m', 'merge', 'side')
+
+
+def per_commit_commits(shell, directory, revision_start, revision_end, first_parent=True, reverse=True):
+    """ The per-commit path of get_commits before the single rev-list pass """
+    options = ''
+    if reverse:
+        options = '%s --reverse' % options
+    if first_parent:
+        options = '%s --first-parent' % options
+    commit_list = list()
+    cmd = shell('git rev-list %s --pretty="%%H" %s..%s | grep -v ^commit' % (options, revision_start, revision_end), cwd=directory)
+    for commit_hash in cmd.output:
+        commit = dict()
+        commit['hash'] = commit_hash
+        cmd = shell('git show -s --pretty="%%P" %s' % commit_hash, cwd=directory)
+        commit['parents'] = cmd.output[0].split(' ')
+        cmd = shell('git show -s --pretty="%%B" %s' % commit_hash, cwd=directory)
+        commit['body'] = cmd.output
+        if len(commit['parents']) > 1:
+            commit['subcommits'] = per_commit_commits(shell, directory, commit['parents'][0], commit['parents'][1], first_parent=False, reverse=False)
+        commit_list.append(commit)
+    return commit_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='read_commits benchmark')
+    parser.add_argument('--commits', type=int, default=300, help='commits in the interval, besides the merge')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from core.colorlog import log
+    from core.repotypes.git import Git
+    from core.repotypes.shellcommand import shell
+    log.setLevel(logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix='gitnetics-bench-')
+    try:
+        make_repository(directory, args.commits)
+        start = time.time()
+        before = per_commit_commits(shell, directory, 'base', 'master')
+        print 'per-commit git show: %d commits in %.2fs' % (len(before), time.time() - start)
+        start = time.time()
+        after = Git(directory).read_commits('base', 'master')
+        print 'read_commits: %d commits in %.2fs' % (len(after), time.time() - start)
+        print 'same commits: %s' % (before == after)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+""" Times Project.get_slices on synthetic recombination intervals, with
+the statuses in upstream order: merged ones, then approved and present
+ones mixed, then missing ones.
+
+Run it against another checkout with --tree to compare, for example
+with the tree before the single pass slicing:
+
+    git worktree add /tmp/gitnetics-before e269402^
+    python bench/slices.py --tree /tmp/gitnetics-before
+    python bench/slices.py
+
+The last column is a digest of the slices, equal between trees when
+they slice in the same way.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+
+
+class StubRecombination(object):
+
+    def __init__(self, status):
+        self.status = status
+
+
+def interval(size, seed):
+    generator = random.Random(seed)
+    merged = generator.randint(0, size / 3)
+    waiting = generator.randint(merged, size)
+    statuses = ['MERGED'] * merged
+    statuses.extend(generator.choice(['APPROVED', 'PRESENT']) for index in range(waiting - merged))
+    statuses.extend(['MISSING'] * (size - waiting))
+    return OrderedDict(('recomb-%d' % index, StubRecombination(status)) for index, status in enumerate(statuses))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='get_slices benchmark')
+    parser.add_argument('--tree', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'), help='gitnetics tree to measure')
+    parser.add_argument('sizes', nargs='*', type=int, default=[1000, 2000, 4000, 10000], help='recombinations in the intervals')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.tree))
+    from core.colorlog import log
+    from core.project import Project
+    log.setLevel(logging.CRITICAL + 1)
+
+    project = Project.__new__(Project)
+    for size in args.sizes:
+        recombinations = interval(size, size)
+        start = time.time()
+        slices = project.get_slices(recombinations)
+        elapsed = time.time() - start
+        segments = sorted((status, [(segment['start'], segment['end']) for segment in slices[status]]) for status in slices)
+        print '%6d recombinations: %.3fs %s' % (size, elapsed, hashlib.sha1(repr(segments)).hexdigest()[:12])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import logging
 import inspect
 import pprint
+import threading
 
 ANSIcolor = "\033[1;%dm"
 endcolor = "\033[0m"
@@ -45,14 +46,43 @@ class ColorLogger(logging.Logger):
 
 
     def debugvar(self, var, *args, **kwargs):
-        frame = inspect.currentframe()
-        stack = inspect.getouterframes(frame)
-        prevframe = stack[1][0]
+        # the caller frame is inspected only when debug is shown
+        if not self.isEnabledFor(logging.DEBUG):
+            return
+        prevframe = inspect.currentframe().f_back
         msg = pprint.pformat(prevframe.f_locals[var])
         self.debug('Variable: %s' % var)
         self.debug(msg, *args, **kwargs)
 
 
+class GroupFilter(logging.Filter):
+    """ Holds back the records emitted between start() and stop() in the
+    current thread, so a project output can be released all together """
+
+    def __init__(self):
+        super(GroupFilter, self).__init__()
+        self.local = threading.local()
+
+    def start(self):
+        self.local.records = list()
+
+    def stop(self):
+        records = self.local.records
+        self.local.records = None
+        return records
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        # records are emitted later, format the message with the values
+        # its arguments have now
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        records.append(record)
+        return False
+
 
 def get_color_log():
     logging.setLoggerClass(ColorLogger)
@@ -60,7 +90,10 @@ def get_color_log():
 
 def get_summary_log():
     logging.setLoggerClass(ColorLogger)
-    return logging.getLogger('logsummary')
+    summary_log = logging.getLogger('logsummary')
+    summary_log.group = GroupFilter()
+    summary_log.addFilter(summary_log.group)
+    return summary_log
 
 
 log = get_color_log()
@@ -0,0 +1,217 @@
+import json
+import Queue
+import sys
+import threading
+import time
+from colorlog import log, logsummary
+from repotypes.shellcommand import stream
+from repotypes.sshtransport import SSHTransport
+
+# gerrit events that may need a scan
+STREAM_EVENTS = ['ref-updated', 'change-merged', 'comment-added', 'patchset-created']
+
+
+class StreamEventsSource(object):
+    """ Events of a gerrit host, read from a gerrit stream-events session
+    on the shared ssh connection. When the session ends a new one is
+    opened, and a 'reconnected' event is reported, as events may have been
+    lost meanwhile """
+
+    finite = False
+    # seconds to wait before opening a new session
+    reconnect_delay = 10
+
+    def __init__(self, host):
+        self.host = host
+        self.transport = SSHTransport.get(host)
+
+    def read(self, events):
+        command = 'gerrit stream-events %s' % ' '.join(['-s %s' % event_type for event_type in STREAM_EVENTS])
+        while True:
+            log.info("Listening to %s events" % self.host)
+            for line in stream(self.transport.command(command).split()):
+                try:
+                    events.put((self.host, json.loads(line)))
+                except ValueError:
+                    log.warning("Unreadable event from %s: %s" % (self.host, line))
+            log.warning("Events stream from %s ended, reconnecting in %d seconds" % (self.host, self.reconnect_delay))
+            time.sleep(self.reconnect_delay)
+            events.put((self.host, {'type': 'reconnected'}))
+
+
+class FileEventSource(object):
+    """ Events read from a file, one json event per line in the format of
+    gerrit stream-events, or from standard input with path '-'. An event
+    may name its gerrit host in a 'host' key, otherwise it is matched by
+    project name only """
+
+    finite = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, events):
+        if self.path == '-':
+            events_file = sys.stdin
+        else:
+            events_file = open(self.path)
+        try:
+            for line in iter(events_file.readline, ''):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    event = None
+                if not isinstance(event, dict):
+                    log.warning("Unreadable event in %s: %s" % (self.path, line))
+                    continue
+                events.put((event.get('host'), event))
+        finally:
+            if events_file is not sys.stdin:
+                events_file.close()
+            # end of the source
+            events.put(None)
+
+
+class Daemon(object):
+    """ Keeps the projects of a Polymerase initialized and runs only the
+    scans affected by the events of some sources. Events arriving close
+    together are handled in a single batch, each affected scan once.
+    Projects with an original repository that is not gerrit get no events,
+    their original branches are scanned every poll_interval seconds """
+
+    # seconds to wait for more events before handling a batch
+    batch_delay = 2.0
+    poll_interval = 300
+
+    def __init__(self, polymerase, sources, batch_delay=None, poll_interval=None):
+        self.polymerase = polymerase
+        self.sources = sources
+        if batch_delay is not None:
+            self.batch_delay = batch_delay
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+
+        # (host, gerrit project) -> [(project name, remote name)]
+        self.watched = dict()
+        self.polled = list()
+        for project_name in polymerase.projects:
+            project_infos = polymerase.projects_infos[project_name]
+            replica = project_infos['replica']
+            self.watched.setdefault((replica['location'], replica['name']), list()).append((project_name, 'replica'))
+            original = project_infos['original']
+            if original['type'] == 'gerrit':
+                self.watched.setdefault((original['location'], original['name']), list()).append((project_name, 'original'))
+            else:
+                self.polled.append(project_name)
+
+    @staticmethod
+    def gerrit_hosts(polymerase):
+        """ Returns the gerrit hosts of the projects of polymerase """
+        hosts = set()
+        for project_name in polymerase.projects:
+            project_infos = polymerase.projects_infos[project_name]
+            hosts.add(project_infos['replica']['location'])
+            if project_infos['original']['type'] == 'gerrit':
+                hosts.add(project_infos['original']['location'])
+        return hosts
+
+    def event_target(self, event):
+        """ Returns the gerrit project and branch changed by event, or
+        None if the event changes no branch """
+        if event.get('type') == 'ref-updated':
+            ref_name = event['refUpdate']['refName']
+            if ref_name.startswith('refs/heads/'):
+                ref_name = ref_name[len('refs/heads/'):]
+            elif ref_name.startswith('refs/'):
+                # changes, tags and meta refs
+                return None
+            return event['refUpdate']['project'], ref_name
+        if event.get('type') in STREAM_EVENTS and 'change' in event:
+            return event['change']['project'], event['change']['branch']
+        return None
+
+    def add_event(self, pending, host, event):
+        """ Adds to pending the scans affected by event, by project """
+        if event.get('type') == 'reconnected':
+            for gerrit_host, gerrit_project in self.watched:
+                if gerrit_host == host:
+                    for project_name, remote_name in self.watched[(gerrit_host, gerrit_project)]:
+                        pending.setdefault(project_name, set()).add(None)
+            return
+        target = self.event_target(event)
+        if target is None:
+            return
+        gerrit_project, branch = target
+        for gerrit_host, watched_project in self.watched:
+            if watched_project != gerrit_project or (host is not None and gerrit_host != host):
+                continue
+            for project_name, remote_name in self.watched[(gerrit_host, watched_project)]:
+                scans = self.polymerase.projects[project_name].get_event_scans(remote_name, branch)
+                if scans:
+                    log.info("%s event on %s %s: %s" % (event['type'], project_name, branch, ', '.join(['%s %s' % scan for scan in sorted(scans)])))
+                    pending.setdefault(project_name, set()).update(scans)
+
+    def run_project_scans(self, project_name, project, pending):
+        project.run_scans(pending[project_name])
+
+    def dispatch(self, pending, first_event):
+        scans = sum([len(pending[project_name]) for project_name in pending])
+        self.polymerase.run_projects(self.run_project_scans, pending, project_names=list(pending))
+        if first_event is not None:
+            logsummary.info("%d scans in %d projects done %.1fs after the first event" % (scans, len(pending), time.time() - first_event))
+        else:
+            logsummary.info("%d scans in %d projects done" % (scans, len(pending)))
+
+    def run(self, initial_scan=True):
+        events = Queue.Queue()
+        for source in self.sources:
+            reader = threading.Thread(target=source.read, args=(events,))
+            reader.daemon = True
+            reader.start()
+        finite_sources = len([source for source in self.sources if source.finite])
+        # the daemon ends with its finite sources, if it has only those
+        endless = finite_sources < len(self.sources)
+
+        if initial_scan:
+            # anything happened while the daemon was not running
+            logsummary.info("Scanning all projects")
+            self.dispatch(dict((project_name, set([None])) for project_name in self.polymerase.projects), None)
+
+        pending = dict()
+        first_event = None
+        next_poll = time.time() + self.poll_interval
+        running = True
+        while running:
+            try:
+                # short waits, so interrupts are not held back
+                item = events.get(timeout=1)
+            except Queue.Empty:
+                item = False
+            if item is None:
+                finite_sources -= 1
+                running = finite_sources > 0 or endless
+            elif item:
+                if first_event is None:
+                    first_event = time.time()
+                try:
+                    self.add_event(pending, *item)
+                except (KeyError, TypeError, AttributeError):
+                    log.warning("Malformed event from %s: %s" % (item[0] or 'file', item[1]))
+
+            now = time.time()
+            if self.polled and now >= next_poll:
+                for project_name in self.polled:
+                    project = self.polymerase.projects[project_name]
+                    pending.setdefault(project_name, set()).update([('original', branch) for branch in project.original_branches])
+                next_poll = now + self.poll_interval
+
+            if not pending:
+                # events without scans to run
+                first_event = None
+            elif first_event is None or now - first_event >= self.batch_delay or not running:
+                self.dispatch(pending, first_event)
+                pending = dict()
+                first_event = None
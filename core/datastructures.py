@@ -6,6 +6,8 @@ from exceptions import *
 
 yaml.add_representer(folded_unicode, folded_unicode_representer)
 yaml.add_representer(literal_unicode, literal_unicode_representer)
+# comments are parsed with the libyaml safe loader when available
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 class Change(object):
 
@@ -63,8 +65,8 @@ class Change(object):
     def reject(self):
         return self.remote.reject_change(self.number, self.patchset_number)
 
-    def upload(self, reviewers=None, successremove=True):
-        result_data = self.remote.upload_change(self.branch, self.topic, reviewers=reviewers, successremove=successremove)
+    def upload(self, reviewers=None, successremove=True, refspecs=None):
+        result_data = self.remote.upload_change(self.branch, self.topic, reviewers=reviewers, successremove=successremove, refspecs=refspecs)
         if result_data:
             self.load_data(result_data)
             #self.number = result_data['number']
@@ -110,6 +112,13 @@ class Recombination(Change):
         self.backportid = None
         self.user_requests = dict()
         self.remote = remote
+        # refspecs the underlayer deferred to the upload push
+        self.pending_refspecs = list()
+
+    def upload(self, reviewers=None, successremove=True):
+        refspecs = self.pending_refspecs
+        self.pending_refspecs = list()
+        return super(Recombination, self).upload(reviewers=reviewers, successremove=successremove, refspecs=refspecs)
 
     def initialize(self, remote):
         self.commit_message = None
@@ -183,25 +192,44 @@ class Recombination(Change):
         #   outcome: completed
         comments_metadata = dict()
         comment_commands = ["DISCARD"]
-        # Maybe it's better to start yaml comments with ---
-        if self.comments:
-            for comment in self.comments:
-                log.debugvar('comment')
-                try:
-                    comment_metadata = yaml.load(comment['message'])
-                    if 'user-request' in comment_metadata and str(comment_metadata['user-request']['comment-id']) in self.user_requests:
-                        self.user_requests[str(comment_metadata['user-request']['comment-id'])]['outcome'] = comment_metadata['user-request']['outcome']
-                        comment_metadata.pop('user-request')
-                    comments_metadata.update(comment_metadata)
-                except (ValueError, yaml.scanner.ScannerError,yaml.parser.ParserError):
-                    for line in comment['message'].split('\n'):
-                        for cc in comment_commands:
-                            rs = re.search('^%s$' % cc, line)
-                            if rs is not None:
-                                self.user_requests[str(comment['timestamp'])] = dict()
-                                self.user_requests[str(comment['timestamp'])]['type'] = cc
-                                self.user_requests[str(comment['timestamp'])]['outcome'] = "open"
+        if not self.comments:
+            return comments_metadata
+
+        # comments analyzed in previous runs are not parsed again, their
+        # outcome is resumed from the recombination store
+        store = getattr(self.underlayer, 'recombination_store', None)
+        number = getattr(self, 'number', None)
+        start = 0
+        if store is not None and number is not None:
+            analysis = store.get_comments_analysis(number)
+            if analysis is not None:
+                processed, last_timestamp, cached_metadata, cached_requests = analysis
+                # comments are never removed, a different history is analyzed again
+                if 0 < processed <= len(self.comments) and self.comments[processed - 1]['timestamp'] == last_timestamp:
+                    start = processed
+                    comments_metadata = cached_metadata
+                    self.user_requests.update(cached_requests)
+        if start == len(self.comments):
+            return comments_metadata
 
+        # Maybe it's better to start yaml comments with ---
+        for comment in self.comments[start:]:
+            log.debugvar('comment')
+            try:
+                comment_metadata = yaml.load(comment['message'], Loader=yaml_loader)
+                if 'user-request' in comment_metadata and str(comment_metadata['user-request']['comment-id']) in self.user_requests:
+                    self.user_requests[str(comment_metadata['user-request']['comment-id'])]['outcome'] = comment_metadata['user-request']['outcome']
+                    comment_metadata.pop('user-request')
+                comments_metadata.update(comment_metadata)
+            except (ValueError, TypeError, yaml.YAMLError):
+                for line in comment['message'].split('\n'):
+                    if line in comment_commands:
+                        self.user_requests[str(comment['timestamp'])] = dict()
+                        self.user_requests[str(comment['timestamp'])]['type'] = line
+                        self.user_requests[str(comment['timestamp'])]['outcome'] = "open"
+
+        if store is not None and number is not None:
+            store.store_comments_analysis(number, len(self.comments), self.comments[-1]['timestamp'], comments_metadata, self.user_requests)
         return comments_metadata
 
     def serve_requests(self):
@@ -219,30 +247,44 @@ class Recombination(Change):
                         self.abandon()
 
     def handle_status(self):
+        """ Runs the operations for the status of the recombination. Returns
+        False if any of them failed """
         self.serve_requests()
+        handled = None
         if self.status == "MISSING":
-            self.missing()
+            handled = self.missing()
         elif self.status == "APPROVED":
-            self.approved()
+            handled = self.approved()
         elif self.status == "MERGED":
-            self.merged()
+            handled = self.merged()
         elif self.status == "PRESENT":
-            self.present()
+            handled = self.present()
         elif self.status == "BLOCKED":
-            self.blocked()
+            handled = self.blocked()
+        # handlers return False only when a failure was logged
+        return handled is not False
 
-    def load_change_data(self, change_data):
-        """ Common load operations for all recombination types """
-        self.load_data(change_data)
-        log.debug(self.commit_message)
+    @staticmethod
+    def parse_commit_message(commit_message):
+        """ Returns the metadata in the yaml commit message of a recombination """
         try:
-            metadata = yaml.load(self.commit_message)
+            metadata = yaml.load(commit_message)
         except (ValueError, yaml.scanner.ScannerError,yaml.parser.ParserError):
             log.error("commit message not in yaml")
             raise DecodeError
         header = metadata['Recombination']
         recomb_header = header.split('~')[0]
         metadata['recomb-type'] = re.sub(':[a-zA-Z0-9]{6}', '',recomb_header)
+        return metadata
+
+    def load_change_data(self, change_data):
+        """ Common load operations for all recombination types """
+        self.load_data(change_data)
+        log.debug(self.commit_message)
+        # data from the recombination store comes already parsed
+        metadata = change_data.get('metadata')
+        if metadata is None:
+            metadata = self.parse_commit_message(self.commit_message)
         if 'recombine-status' in metadata:
             self.status = metadata['recombine-status']
         metadata.update(self.analyze_comments())
@@ -269,12 +311,15 @@ class OriginalDiversityRecombination(Recombination):
         self.patches_source_name = 'diversity'
         self.set_status()
 
-    def load_change_data(self, change_data, original_remote=None, patches_remote=None, diversity_change=None):
+    def load_change_data(self, change_data, original_remote=None, patches_remote=None, diversity_change=None, original_change=None):
         self.main_source_name = 'original'
         self.patches_source_name = 'diversity'
         metadata = super(OriginalDiversityRecombination, self).load_change_data(change_data)
-        self.original_change = Change(remote=original_remote)
-        self.original_change.load_from_remote(metadata['sources']['main']['id'], branch=metadata['sources']['main']['branch'])
+        # the original change may come already resolved
+        if original_change is None:
+            original_change = Change(remote=original_remote)
+            original_change.load_from_remote(metadata['sources']['main']['id'], branch=metadata['sources']['main']['branch'])
+        self.original_change = original_change
         # Set real commit as revision
         self.original_change.revision = metadata['sources']['main']['revision']
         self.diversity_change = diversity_change
@@ -304,25 +349,32 @@ class OriginalDiversityRecombination(Recombination):
             log.error("Recombination attempt unsuccessful")
             raise UploadError
         try:
-            self.upload()
+            uploaded = self.upload()
         except UploadError:
             log.error("upload of recombination with change %s did not succeed. Exiting" % self.uuid)
             raise UploadError
+        return uploaded
 
     def update_target_branch(self):
         target_branch = self.underlayer.branch_maps['original->target'][self.original_change.branch]
         self.underlayer.update_target_branch(self.target_replacement_branch, target_branch)
 
     def approved(self):
+        handled = True
         try:
             self.sync_replica()
         except RecombinationSyncReplicaError:
             log.error("Replica could not be synced")
+            handled = False
         self.update_target_branch()
         try:
-            self.submit()
+            if not self.submit():
+                log.error("Recombination not submitted")
+                handled = False
         except RecombinationSubmitError:
             log.error("Recombination not submitted")
+            handled = False
+        return handled
 
     def merged(self):
         log.warning("branch is out of sync with original")
@@ -357,21 +409,27 @@ class EvolutionDiversityRecombination(Recombination):
             self.backport_change.commit_message = self.mangle_commit_message(self.evolution_change.commit_message)
         self.follow_backport_status()
 
-    def load_change_data(self, change_data, original_remote=None, patches_remote=None, diversity_change=None):
+    def load_change_data(self, change_data, original_remote=None, patches_remote=None, diversity_change=None, evolution_change=None, backport_change=None):
         self.main_source_name = 'evolution'
         self.patches_source_name = 'diversity'
         metadata = super(EvolutionDiversityRecombination, self).load_change_data(change_data)
-        self.evolution_change = Change(remote=original_remote)
-        self.evolution_change.load_from_remote(metadata['sources']['main']['id'], branch=metadata['sources']['main']['branch'])
+        # evolution and backport changes may come already resolved
+        if evolution_change is None:
+            evolution_change = Change(remote=original_remote)
+            evolution_change.load_from_remote(metadata['sources']['main']['id'], branch=metadata['sources']['main']['branch'])
+        self.evolution_change = evolution_change
         self.main_source = self.evolution_change
         # Set real commit as revision
         self.evolution_change.revision = metadata['sources']['main']['revision']
         self.diversity_change = diversity_change
         self.patches_source = self.diversity_change
-        self.backport_change = Change(remote=patches_remote)
         if 'backport-id' in metadata and metadata['backport-id'] is not None:
-            self.backport_change.load_from_remote(metadata['backport-id'], branch=metadata['sources']['patches']['branch'])
+            if backport_change is None:
+                backport_change = Change(remote=patches_remote)
+                backport_change.load_from_remote(metadata['backport-id'], branch=metadata['sources']['patches']['branch'])
+            self.backport_change = backport_change
         else:
+            self.backport_change = Change(remote=patches_remote)
             self.backport_change.commit_message = metadata['sources']['patches']['commit-message']
             self.backport_change.branch = metadata['sources']['patches']['branch']
         if 'backport-test-results' in metadata:
@@ -476,12 +534,15 @@ class ReplicaMutationRecombination(Recombination):
         self.patches_source_name = 'mutation'
         self.set_status()
 
-    def load_change_data(self, change_data, replica_remote=None, mutation_change=None):
+    def load_change_data(self, change_data, replica_remote=None, mutation_change=None, replica_change=None):
         self.main_source_name = 'replica'
         self.patches_source_name = 'mutation'
         metadata = super(ReplicaMutationRecombination, self).load_change_data(change_data)
-        self.replica_change = Change(remote=replica_remote)
-        self.replica_change.load_from_remote(metadata['sources']['main']['id'], branch=metadata['sources']['main']['branch'])
+        # the replica change may come already resolved
+        if replica_change is None:
+            replica_change = Change(remote=replica_remote)
+            replica_change.load_from_remote(metadata['sources']['main']['id'], branch=metadata['sources']['main']['branch'])
+        self.replica_change = replica_change
         self.mutation_change = mutation_change
         if 'target-replacement-branch' not in metadata:
             self.target_replacement_branch  = re.sub('recomb', 'target', self.branch)
@@ -511,29 +572,36 @@ class ReplicaMutationRecombination(Recombination):
             log.error("Recombination attempt unsuccessful")
             raise UploadError
         try:
-            self.upload()
+            uploaded = self.upload()
         except UploadError:
             log.error("upload of recombination with change %s did not succeed. Exiting" % self.uuid)
             raise UploadError
+        return uploaded
 
     def update_target_branch(self):
         target_branch = self.underlayer.branch_maps['replica->target'][self.replica_change.branch]
         self.underlayer.update_target_branch(self.target_replacement_branch, target_branch)
 
     def approved(self):
+        handled = True
         if self.mutation_change.remote_status != "MERGED":
             try:
                 self.mutation_change.approve()
                 self.mutation_change.submit()
             except RecombinationApproveError:
                 log.error("Originating change approval failed")
+                handled = False
             except RecombinationSubmitError:
                 log.error("Originating change submission failed")
+                handled = False
         self.update_target_branch()
         if self.remote_status != "MERGED":
-            self.submit()
+            if not self.submit():
+                log.error("Recombination not submitted")
+                handled = False
         else:
             log.warning("Recombination already submitted")
+        return handled
         # update existing recombination from upstream changes
         # for change in midstream_gerrit.gather_current_merges(patches_revision):
         #    local_repo.merge_fortests(change['upstream_revision'], patches_revision)
@@ -8,6 +8,9 @@ class MergeError(Exception):
 class RemoteFetchError(Exception):
     pass
 
+class QueryError(Exception):
+    pass
+
 class TestError(Exception):
     pass
 class RecombinationApproveError(object):
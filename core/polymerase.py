@@ -1,13 +1,15 @@
 import copy
 import traceback
 from colorlog import log, logsummary
+from daemon import Daemon, FileEventSource, StreamEventsSource
+from multiprocessing.pool import ThreadPool
 from project import Project
 import sys
 
 
 class Polymerase(object):
 
-    def __init__(self, projects_conf, base_dir, filter_projects=None, filter_method=None, filter_branches=None, fetch=True):
+    def __init__(self, projects_conf, base_dir, filter_projects=None, filter_method=None, filter_branches=None, fetch=True, jobs=1):
         self.projects = dict()
         self.projects_conf = projects_conf
         self.base_dir = base_dir
@@ -58,87 +60,149 @@ class Polymerase(object):
             raise ValueError
         log.debugvar('projects')
 
+        self.projects_infos = projects
+        self.fetch = fetch
+        self.jobs = jobs
+
         logsummary.info("initializing and updating local repositories for relevant projects")
 
-        for project_name in projects:
+        self.foreach_project(self.init_project, list(projects))
+
+    def init_project(self, project_name):
+        try:
+            self.projects[project_name] = Project(project_name, self.projects_infos[project_name], self.base_dir + "/"+ project_name, fetch=self.fetch)
+            logsummary.info("Project: %s initialized" % project_name)
+        except Exception, e:
+            traceback.print_exc(file=sys.stdout)
+            log.error(e)
+            logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
+
+    def foreach_project(self, function, project_names):
+        """ Calls function(project_name) for every project, serially or with
+        a pool of self.jobs threads. Returns the results by project """
+        results = dict()
+        if self.jobs <= 1 or not project_names:
+            for project_name in project_names:
+                results[project_name] = function(project_name)
+            return results
+
+        def grouped(project_name):
+            logsummary.group.start()
             try:
-                self.projects[project_name] = Project(project_name, projects[project_name], self.base_dir + "/"+ project_name, fetch=fetch)
-                logsummary.info("Project: %s initialized" % project_name)
-            except Exception, e:
-                traceback.print_exc(file=sys.stdout)
-                log.error(e)
-                logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
+                result = function(project_name)
+            finally:
+                records = logsummary.group.stop()
+            return project_name, result, records
+
+        pool = ThreadPool(processes=min(self.jobs, len(project_names)))
+        try:
+            # summary output of each project is released in one block
+            # as soon as the project is finished
+            for project_name, result, records in pool.imap_unordered(grouped, project_names):
+                for record in records:
+                    logsummary.handle(record)
+                results[project_name] = result
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def run_project(self, project_name, step, args, kwargs):
+        """ Runs a single project step, isolating its failures from the
+        other projects """
+        try:
+            return step(project_name, self.projects[project_name], *args, **kwargs)
+        except Exception, e:
+            traceback.print_exc(file=sys.stdout)
+            log.error(e)
+            logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
+        return None
+
+    def run_projects(self, step, *args, **kwargs):
+        """ Runs step on every initialized project """
+        project_names = kwargs.pop('project_names', list(self.projects_infos))
+        project_names = [project_name for project_name in project_names if project_name in self.projects]
+        return self.foreach_project(lambda project_name: self.run_project(project_name, step, args, kwargs), project_names)
+
+    def report_skipped(self, results):
+        """ Reports the projects whose scans were all skipped, as nothing
+        changed since their last run """
+        skipped = [project_name for project_name in results if results[project_name]]
+        logsummary.info("%d of %d projects unchanged since the last scan, skipped" % (len(skipped), len(results)))
 
     def poll_original(self):
         logsummary.info('Polling original for new changes. Checking status of all changes.')
-        for project_name in self.projects:
-            try:
-                logsummary.info('Polling project: %s' % project_name)
-                project = self.projects[project_name]
-                project.poll_original_branches()
-            except Exception, e:
-                traceback.print_exc(file=sys.stdout)
-                log.error(e)
-                logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
+        self.report_skipped(self.run_projects(self.poll_original_project))
+
+    def poll_original_project(self, project_name, project):
+        logsummary.info('Polling project: %s' % project_name)
+        return project.poll_original_branches()
 
     def poll_replica(self, patches_branch=None):
         log.info("Scanning replica repos for new patches")
-        for project_name in self.projects:
-            try:
-                project=self.projects[project_name]
-                project.scan_replica_patches(patches_branch=patches_branch)
-            except Exception, e:
-                traceback.print_exc(file=sys.stdout)
-                log.error(e)
-                logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
-
-    def prepare_tests(self, tests_basedir, recomb_id=None):
+        self.report_skipped(self.run_projects(self.poll_replica_project, patches_branch=patches_branch))
+
+    def poll_replica_project(self, project_name, project, patches_branch=None):
+        return project.poll_replica_branches(patches_branch=patches_branch)
+
+    def prepare_tests(self, tests_basedir, recomb_id=None, export_mode='archive', export_jobs=1):
         logsummary.info('Fetching untested recombinations')
         tester_vars = dict()
         tester_vars['projects_conf'] = { 'projects': self.projects_conf }
-        for project_name in self.projects:
-            logsummary.info('Project: %s' % project_name)
-            project = self.projects[project_name]
-            log.debugvar('recomb_id')
-            #try:
-            changes_infos = project.fetch_untested_recombinations(tests_basedir, recomb_id=recomb_id)
-            for change_number in changes_infos:
-                tester_vars[change_number] = changes_infos[change_number]
-           # except Exception, e:
-            #    logsummary.info("Problem with project %s: %s. Skipping" % (project_name, e))
+        results = self.run_projects(self.prepare_tests_project, tests_basedir, recomb_id=recomb_id, export_mode=export_mode, export_jobs=export_jobs)
+        for project_name in results:
+            changes_infos = results[project_name]
+            if changes_infos:
+                tester_vars.update(changes_infos)
         return tester_vars
 
+    def prepare_tests_project(self, project_name, project, tests_basedir, recomb_id=None, export_mode='archive', export_jobs=1):
+        logsummary.info('Project: %s' % project_name)
+        log.debugvar('recomb_id')
+        return project.fetch_untested_recombinations(tests_basedir, recomb_id=recomb_id, export_mode=export_mode, jobs=export_jobs)
+
     def vote_recombinations(self, test_results, recomb_id=None):
-        for target_project in test_results:
-            if target_project in self.projects:
-                project = self.projects[target_project]
-                project_test_results = test_results[target_project]
-                if recomb_id != None:
-                    if recomb_id in project_test_results:
-                        project.vote_recombinations(project_test_results, recomb_id=recomb_id)
-                else:
-                    project.vote_recombinations(project_test_results)
+        target_projects = [target_project for target_project in test_results if target_project in self.projects_infos]
+        self.run_projects(self.vote_recombinations_project, test_results, recomb_id=recomb_id, project_names=target_projects)
+
+    def vote_recombinations_project(self, project_name, project, test_results, recomb_id=None):
+        project_test_results = test_results[project_name]
+        if recomb_id != None:
+            if recomb_id in project_test_results:
+                project.vote_recombinations(project_test_results, recomb_id=recomb_id)
+        else:
+            project.vote_recombinations(project_test_results)
 
     def check_approved_recombinations(self, recomb_id=None):
         log.info("Checking for approved recombinations to handle")
-        for project_name in self.projects:
-            try:
-                log.info("Checking project '%s'" % project_name)
-                project = self.projects[project_name]
-                project.check_approved_recombinations(recomb_id=recomb_id)
-            except Exception, e:
-                traceback.print_exc(file=sys.stdout)
-                log.error(e)
-                logsummary.error("Project %s skipped, reason: %s" % (project_name, e))
-
-    def janitor(self):
-        for project_name in self.projects:
-            project = self.projects[project_name]
-            log.info("Cleaning up %s replica repositories" % project_name)
-            log.info("Deleting service branches from mirror")
-            project.delete_service_branches()
-            log.info("delete stale branches from replica")
-            project.delete_stale_branches()
+        results = self.run_projects(self.check_approved_recombinations_project, recomb_id=recomb_id)
+        if recomb_id is None:
+            self.report_skipped(results)
+
+    def check_approved_recombinations_project(self, project_name, project, recomb_id=None):
+        log.info("Checking project '%s'" % project_name)
+        return project.check_approved_recombinations(recomb_id=recomb_id)
+
+    def serve(self, events_path=None, batch_delay=None, poll_interval=None, initial_scan=True):
+        """ Runs the scans affected by gerrit events as they arrive, until
+        interrupted. Events are read from events_path instead of the gerrit
+        hosts of the projects if given """
+        if events_path:
+            sources = [FileEventSource(events_path)]
+        else:
+            sources = [StreamEventsSource(host) for host in sorted(Daemon.gerrit_hosts(self))]
+        daemon = Daemon(self, sources, batch_delay=batch_delay, poll_interval=poll_interval)
+        daemon.run(initial_scan=initial_scan)
+
+    def janitor(self, dry_run=False):
+        self.run_projects(self.janitor_project, dry_run=dry_run)
+
+    def janitor_project(self, project_name, project, dry_run=False):
+        log.info("Cleaning up %s replica repositories" % project_name)
+        log.info("Deleting service branches from mirror")
+        project.delete_service_branches(dry_run=dry_run)
+        log.info("delete stale branches from replica")
+        project.delete_stale_branches(dry_run=dry_run)
             # non-existing:
             # for branch in watched branches
             # if branch-tag not it branches:
@@ -1,16 +1,21 @@
+import hashlib
 import pprint
 import re
-import copy
 import os
+import time
 import yaml
 from colorlog import log, logsummary
 from collections import OrderedDict
 from repotypes.git import Underlayer
+from testresults import OUTCOMES
 from exceptions import *
 
 
 class Project(object):
 
+    # snapshots of the last complete scans
+    scans_state_name = 'scans.yaml'
+
     status_impact = {
         "MERGED": 2,
         "APPROVED": 1,
@@ -20,6 +25,7 @@ class Project(object):
 
     def __init__(self, project_name, project_info, local_dir, fetch=True):
         self.project_name = project_name
+        self.project_info = project_info
         self.recombinations = dict()
         self.commits = dict()
 
@@ -36,16 +42,18 @@ class Project(object):
             self.test_types = project_info["replica"]["tests"]
 
         self.replication_strategy = project_info['replication-strategy']
-        self.test_minimum_score = 0
+        # recombinations need a percentage of passed tests above this
+        self.test_minimum_score = self.replica_project.get('tests-minimum-score', 0)
 
         self.patches_branch_suffix = "-patches"
         self.target_branch_suffix = "-tag"
         # Set up local repo
         self.underlayer = Underlayer(project_name, local_dir)
+        self.underlayer.deferred_push = self.replica_project.get('push-mode', 'immediate') == 'deferred'
 
         # Set up remotes
-        self.underlayer.set_replica(self.replica_project['location'], self.replica_project['name'], fetch=fetch)
-        self.underlayer.set_original(self.original_project['type'], self.original_project['location'], self.original_project['name'], fetch=fetch)
+        self.underlayer.set_replica(self.replica_project['location'], self.replica_project['name'], fetch=fetch, rest_url=self.get_rest_url(self.replica_project))
+        self.underlayer.set_original(self.original_project['type'], self.original_project['location'], self.original_project['name'], fetch=fetch, rest_url=self.get_rest_url(self.original_project))
 
         if "mirror" in project_info['replica']:
             self.underlayer.set_replica_mirror(project_info['replica']['mirror'], self.replica_project['name'],fetch=fetch)
@@ -76,7 +84,16 @@ class Project(object):
                 # no advancement will be performed past this revision on this branch
                 self.ref_locks[branch] = self.replica_project['ref-locks'][branch]
 
+    def get_rest_url(self, repo_info):
+        # gerrit api is ssh unless rest is explicitly selected
+        if repo_info.get('api', 'ssh') == 'rest':
+            return repo_info['rest-url']
+        return None
+
     def get_slices(self, recombinations):
+        """ Splits the recombinations of an interval in runs of the same
+        status, in a single pass. Runs are start/end indexes in the
+        interval, grouped by status """
         slices = {
             "MERGED": [],
             "APPROVED": [],
@@ -85,51 +102,31 @@ class Project(object):
         }
         previous_status = None
         previous_impact = None
-        current_slice = {}
+        previous_recomb_id = None
+        segment = None
 
-        # Slice
-        if recombinations:
-            recomb_list = list(recombinations)
-        else:
-            recomb_list = []
-
-        for index, recomb_id in enumerate(recomb_list):
-            replica_change = recombinations[recomb_id]
+        if not recombinations:
+            return slices
 
-            # creates slices to apply to change list
+        for index, recomb_id in enumerate(recombinations):
             # every status may have multiple slices, but this situation is tolerated
             # only between PRESENT' and 'APPROVED' statuses
             # any other complicated mix is a violation of upstream order
-            status = replica_change.status
-            impact =  self.status_impact[status]
-            previous_change_id = None
-            # Handle current status slice, archive previous slice
-            try:
-                segment = current_slice[status]
-            except KeyError:
-                if previous_status:
-                    slices[previous_status].append(copy.deepcopy(current_slice[previous_status]))
-                    del(current_slice[previous_status])
-                current_slice[status] = {}
-                segment = current_slice[status]
-                segment['start'] = index
+            status = recombinations[recomb_id].status
+            impact = self.status_impact[status]
+            if previous_status and impact > previous_impact:
+                log.critical("Constraint violation error: status %s at index %d (change:%s) of changes list in interval is more advanced than previous status %s at index %d (change: %s)" % (status, index, recomb_id, previous_status, index-1, previous_recomb_id))
+                log.critical("This means that midstream is broken")
+                raise ConstrainViolationError
+            if status == previous_status:
                 segment['end'] = index + 1
-            # init/extend current slice
-            if previous_status:
-                if impact > previous_impact:
-                    log.critical("Constraint violation error: status %s at index %d (change:%s) of changes list in interval is more advanced than previous status %s at index %d (change: %s)" % (status, index, recomb_id, previous_status, index-1, previous_change_id))
-                    log.critical("This means that midstream is broken")
-                    raise ConstrainViolationError
-                if status == previous_status:
-                    segment['end'] = segment['end'] + 1
-            # end of status list
-            if index == len(list(recombinations)) - 1:
-                    slices[status].append(copy.deepcopy(current_slice[status]))
-                    del(current_slice[status])
+            else:
+                segment = {'start': index, 'end': index + 1}
+                slices[status].append(segment)
 
             previous_status = status
             previous_impact = impact
-            previous_change_id = recomb_id
+            previous_recomb_id = recomb_id
 
         return slices
 
@@ -143,9 +140,13 @@ class Project(object):
         self.recombinations[original_branch] = self.get_recombinations_by_interval(original_branch)
         slices = self.get_slices(self.recombinations[original_branch])
         recombinations = self.recombinations[original_branch]
+        # segments address recombinations by their position in the interval,
+        # an interval without new commits has no recombinations
+        recomb_ids = list(recombinations or ())
 
 
         log.debugvar('slices')
+        handled = True
         # Master sync on merged changes
         # we really need only the last commit in the slice
         # we advance the master to that, and all the others will be merged too
@@ -155,48 +156,87 @@ class Project(object):
             # but check first if the change was changed with a merge commit
             # if yes, push THAT to master, if not, it's just a fast forward
             segment = slices['MERGED'][0]
-            recomb_id = list(recombinations)[segment['end'] - 1]
+            recomb_id = recomb_ids[segment['end'] - 1]
             recombination = recombinations[recomb_id]
-            recombination.handle_status()
+            handled = recombination.handle_status() and handled
 
         # Gerrit operations from approved changes
         # NOthing 'approved' can be merged if it has some "present" before in the history
-        skip_list = set()
-        for index, approved_segment in enumerate(slices['APPROVED']):
-            for present_segment in slices['PRESENT']:
-                if present_segment['start'] < approved_segment['start']:
-                    skip_list.add(index)
-
-        for index in list(skip_list)[::-1]:
+        # segments are in interval order, the first present one is enough
+        skip_list = list()
+        if slices['PRESENT']:
+            first_present_start = slices['PRESENT'][0]['start']
+            for index, approved_segment in enumerate(slices['APPROVED']):
+                if first_present_start < approved_segment['start']:
+                    skip_list.append(index)
+
+        for index in skip_list[::-1]:
             segment = slices['APPROVED'].pop(index)
-            for recomb_id in list(recombinations)[segment['start']:segment['end']]:
+            for recomb_id in recomb_ids[segment['start']:segment['end']]:
                 log.warning("Recombination %s is approved but waiting for previous unapproved changes, skipping" % recomb_id)
 
         # Merge what remains
         for segment in slices['APPROVED']:
-            for recomb_id in list(recombinations)[segment['start']:segment['end']]:
+            for recomb_id in recomb_ids[segment['start']:segment['end']]:
                 recombination = recombinations[recomb_id]
-                recombination.handle_status()
+                handled = recombination.handle_status() and handled
 
         # Notify of presence
         for segment in slices['PRESENT']:
-            for recomb_id in list(recombinations)[segment['start']:segment['end']]:
+            for recomb_id in recomb_ids[segment['start']:segment['end']]:
                 recombination = recombinations[recomb_id]
                 log.warning("Recombination %s already present in replica gerrit as change %s and waiting for approval" % (recomb_id, recombination.number))
-                recombination.handle_status()
+                handled = recombination.handle_status() and handled
 
         # Gerrit operations for missing changes
         for segment in slices['MISSING']:
-            for recomb_id in list(recombinations)[segment['start']:segment['end']]:
+            for recomb_id in recomb_ids[segment['start']:segment['end']]:
                 log.warning("Recombination %s is missing from replica gerrit" % recomb_id)
                 recombination = recombinations[recomb_id]
-                recombination.handle_status()
+                handled = recombination.handle_status() and handled
 
-        return True
+        return handled
+
+    def get_scan_snapshot(self, original_branch):
+        """ Returns what the scans of original_branch depend on: the heads
+        of the branches involved and the project configuration """
+        replica_branch = self.underlayer.branch_maps['original->replica'][original_branch]
+        heads = dict()
+        heads['original/%s' % original_branch] = self.underlayer.get_revision('original/%s' % original_branch)
+        for branch in (replica_branch, self.underlayer.branch_maps['original->patches'][original_branch], self.underlayer.branch_maps['original->target'][original_branch]):
+            heads['replica/%s' % branch] = self.underlayer.get_revision('replica/%s' % branch)
+        return {
+            'time': int(time.time()),
+            'heads': heads,
+            'config': hashlib.sha1(yaml.safe_dump(self.project_info)).hexdigest(),
+        }
+
+    def scan_if_changed(self, scan, original_branch, function, *args, **kwargs):
+        """ Calls function for the scan of original_branch, unless nothing
+        it depends on changed since its last complete run: same heads, same
+        configuration and no change updated in replica gerrit. A run is
+        complete when function returns True, otherwise the next one scans
+        again. Returns True if the scan is skipped """
+        key = '%s:%s' % (scan, original_branch)
+        snapshot = self.get_scan_snapshot(original_branch)
+        previous = (self.underlayer.load_state(self.scans_state_name) or dict()).get(key)
+        if previous is not None and previous['heads'] == snapshot['heads'] and previous['config'] == snapshot['config'] and not self.underlayer.replica_remote.updated_since(previous['time']):
+            log.info("Nothing changed for %s scan of %s since the last one, skipping" % (scan, original_branch))
+            return True
+        if not function(*args, **kwargs):
+            return False
+        # changes made by the scan itself are seen by the next one
+        state = self.underlayer.load_state(self.scans_state_name) or dict()
+        state[key] = snapshot
+        self.underlayer.save_state(self.scans_state_name, state)
+        return False
 
     def poll_original_branches(self):
+        """ Returns True if all the branches were unchanged """
+        skipped = True
         for branch in self.original_branches:
-            self.scan_original_distance(branch)
+            skipped = self.scan_if_changed('original', branch, self.scan_original_distance, branch) and skipped
+        return skipped
 
     def get_recombinations_by_interval(self, original_branch):
         ref_end = 'original/%s' % (original_branch)
@@ -227,7 +267,21 @@ class Project(object):
             return recombinations
         return None
 
+    def poll_replica_branches(self, patches_branch=None):
+        """ Returns True if all the patches branches were unchanged """
+        if patches_branch is not None and patches_branch not in self.underlayer.branch_maps['patches->replica']:
+            # not a watched branch, nothing to compare
+            self.scan_replica_patches(patches_branch=patches_branch)
+            return False
+        skipped = True
+        for original_branch in self.original_branches:
+            if patches_branch is None or self.underlayer.branch_maps['original->patches'][original_branch] == patches_branch:
+                skipped = self.scan_if_changed('patches', original_branch, self.scan_replica_patches, patches_branch=self.underlayer.branch_maps['original->patches'][original_branch]) and skipped
+        return skipped
+
     def scan_replica_patches(self, patches_branch=None):
+        """ Returns False if a recombination of the patches branches was
+        not handled """
         # Mutations are only handled one at a time per branch
         if patches_branch:
             patches_branches = [patches_branch]
@@ -236,17 +290,19 @@ class Project(object):
             for original_branch in self.original_branches:
                 patches_branches.append(self.underlayer.branch_maps['original->patches'][original_branch])
 
+        handled = True
         for patches_branch in patches_branches:
             recombination, remaining_changes = self.underlayer.get_recombination_from_patches(patches_branch)
             # TODO: handle new patchset on same branch-patches review.
             if recombination:
                 recomb = recombination.__dict__
                 log.debugvar('recomb')
-                recombination.handle_status()
+                handled = recombination.handle_status() and handled
                 if remaining_changes:
                     log.warning("Remaining mutation changes %s will be handled in order one at a time after recombination %s is completed " % (' '.join(remaining_changes), recombination.uuid))
             else:
                 logsummary.info("Project %s no new patches in patches branch %s" % (self.project_name, patches_branch))
+        return handled
 
     def check_approved_recombinations(self, recomb_id=None):
         if recomb_id:
@@ -257,9 +313,49 @@ class Project(object):
             elif recomb_type == 'original-diversity' or recomb_type == "evolution-diversity":
                 return self.scan_original_distance(branch)
         else:
+            skipped = True
             for branch in self.original_branches:
                 patches_branch = self.underlayer.branch_maps['original->patches'][branch]
-                self.scan_replica_patches(patches_branch=patches_branch)
+                skipped = self.scan_if_changed('patches', branch, self.scan_replica_patches, patches_branch=patches_branch) and skipped
+                skipped = self.scan_if_changed('original', branch, self.scan_original_distance, branch) and skipped
+            return skipped
+
+    def get_event_scans(self, remote_name, branch):
+        """ Returns the scans affected by a change on branch in the original
+        or replica remote, as (scan, branch) pairs. scan is 'original' for
+        scan_original_distance on an original branch, 'patches' for
+        scan_replica_patches on a patches branch """
+        scans = set()
+        for original_branch in self.original_branches:
+            if remote_name == 'original':
+                if branch == original_branch:
+                    scans.add(('original', original_branch))
+                continue
+            replica_branch = self.underlayer.branch_maps['original->replica'][original_branch]
+            target_branch = self.underlayer.branch_maps['original->target'][original_branch]
+            patches_branch = self.underlayer.branch_maps['original->patches'][original_branch]
+            if branch == patches_branch or branch.startswith('recomb-patches-%s-' % replica_branch):
+                scans.add(('patches', patches_branch))
+            if branch in (replica_branch, target_branch) or branch.startswith('recomb-original-%s-' % original_branch) or branch.startswith('recomb-evolution-%s-' % original_branch):
+                scans.add(('original', original_branch))
+        return scans
+
+    def run_scans(self, scans):
+        """ Runs the given scans on up to date remotes. A None scan runs
+        them all, like merge-recombinations """
+        # a new run on the same local repository
+        self.underlayer.fetches.reset()
+        self.underlayer.fetch('original')
+        self.underlayer.fetch('replica')
+        self.underlayer.fetch_changes('replica')
+        if None in scans:
+            self.check_approved_recombinations()
+            return
+        # mutations first, like merge-recombinations
+        for scan, branch in sorted(scans, reverse=True):
+            if scan == 'patches':
+                self.scan_replica_patches(patches_branch=branch)
+            elif scan == 'original':
                 self.scan_original_distance(branch)
 
     def get_reverse_dependencies(self, tags=[]):
@@ -271,9 +367,9 @@ class Project(object):
                     break
         return rev_deps
 
-    def fetch_untested_recombinations(self, test_basedir, recomb_id=None):
+    def fetch_untested_recombinations(self, test_basedir, recomb_id=None, export_mode='archive', jobs=1):
         changes_infos = dict()
-        dirlist = self.underlayer.fetch_recombinations(test_basedir, "untested", recomb_id=recomb_id)
+        dirlist = self.underlayer.fetch_recombinations(test_basedir, "untested", recomb_id=recomb_id, export_mode=export_mode, jobs=jobs)
 
         if not dirlist:
             logsummary.info("Project '%s': no untested recombinations" % self.project_name)
@@ -303,14 +399,34 @@ class Project(object):
         return changes_infos
 
     def get_test_score(self, test_results):
+        """ Returns the percentage of passed tests among the ones run, and
+        a description of the failures if any. A test type without results,
+        missing or unreadable, scores 0 """
+        totals = dict((outcome, 0) for outcome in OUTCOMES)
+        failures = list()
+        missing_results = False
         for project_name in test_results:
             for test_type in test_results[project_name]:
                 test_output = test_results[project_name][test_type]
                 if test_output is None:
-                    # We are accepting everything for now
-                    return (100, None)
-                    #return (0, "missing test results")
-        return (100, None)
+                    # a crashed run may leave no results or truncated ones
+                    missing_results = True
+                    failures.append("%s %s: missing or unreadable results" % (project_name, test_type))
+                    continue
+                for outcome in OUTCOMES:
+                    totals[outcome] += test_output[outcome]
+                if test_output['failed'] or test_output['errors']:
+                    failures.append("%s %s: %d failed, %d errors" % (project_name, test_type, test_output['failed'], test_output['errors']))
+        run = totals['passed'] + totals['failed'] + totals['errors']
+        if missing_results:
+            score = 0
+        elif not run:
+            return (100, None)
+        else:
+            score = totals['passed'] * 100 / run
+        if not failures:
+            return (score, None)
+        return (score, "; ".join(failures))
 
     def vote_recombinations(self, test_results, recomb_id=None):
         if recomb_id:
@@ -318,9 +434,19 @@ class Project(object):
         else:
             recombs = [recomb for recomb in test_results]
 
+        # all the changes are fetched at once, and all the votes posted
+        # together, with a single review carrying both comment and labels
+        recombinations = self.underlayer.get_recombinations(recombs)
+        reviews = list()
+        verdicts = dict()
         for recomb_id in recombs:
-            recombination = self.underlayer.get_recombination(recomb_id)
+            try:
+                recombination = recombinations[str(recomb_id)]
+            except KeyError:
+                logsummary.error("Recombination %s not found in replica, not voting" % recomb_id)
+                continue
             test_score, test_analysis = self.get_test_score(test_results[recomb_id])
+            review_input = dict()
             if test_score > self.test_minimum_score:
                 if self.replication_strategy == "lock-and-backports":
                     comment_data = dict()
@@ -333,19 +459,27 @@ class Project(object):
                     comment_data['backport-test-results']['Code-Review'] = 0
                     comment_data['backport-test-results']['Verified'] = "1"
                     comment_data['backport-test-results']['reviewers'] = self.replica_project['success_reviewers_list']
-                    comment = yaml.dump(comment_data)
-                    recombination.comment(comment)
-                recombination.approve()
-                logsummary.info("Recombination %s Approved" % recomb_id)
+                    review_input['message'] = yaml.dump(comment_data)
+                review_input['labels'] = {'Code-Review': 2, 'Verified': 1}
+                verdicts[recombination.number] = (recomb_id, "Approved")
+            else:
+                review_input['labels'] = {'Code-Review': -2, 'Verified': -1}
+                verdicts[recombination.number] = (recomb_id, "Rejected: %s" % test_analysis)
+            reviews.append((recombination.number, recombination.patchset_number, review_input))
+
+        results = self.underlayer.recomb_remote.review_changes(reviews)
+        for number, patchset, review_input in reviews:
+            recomb_id, verdict = verdicts[number]
+            if results[number]:
+                logsummary.info("Recombination %s %s" % (recomb_id, verdict))
             else:
-                recombination.reject()
-                logsummary.info("Recombination %s Rejected: %s" % (recomb_id, test_analysis))
+                logsummary.error("Recombination %s vote failed, would have been %s" % (recomb_id, verdict))
 
-    def delete_service_branches(self):
+    def delete_service_branches(self, dry_run=False):
         # cleanup github repos from recomb branches WIP
-        self.underlayer.delete_service_branches()
+        self.underlayer.delete_service_branches(dry_run=dry_run)
 
-    def delete_stale_branches(self):
+    def delete_stale_branches(self, dry_run=False):
         recomb_active_branches = list()
         target_stale_branches = list()
         recomb_all_branches = self.underlayer.list_branches('replica', pattern='recomb*')
@@ -356,8 +490,7 @@ class Project(object):
         log.debugvar('recomb_active_branches')
         recomb_stale_branches = list(set(recomb_all_branches) - set(recomb_active_branches))
         log.debugvar('recomb_stale_branches')
-        self.underlayer.delete_remote_branches('replica', recomb_stale_branches)
         for recomb_branch in recomb_stale_branches:
             target_stale_branches.append(re.sub('recomb-','target-',recomb_branch))
-        self.underlayer.delete_remote_branches('replica', target_stale_branches)
+        self.underlayer.delete_remote_branches('replica', recomb_stale_branches + target_stale_branches, dry_run=dry_run)
 
@@ -0,0 +1,77 @@
+import subprocess
+import threading
+from ..colorlog import log
+
+
+class CatFile(object):
+    """ Long lived git cat-file --batch co-process. Objects of a repository
+    are read through a pipe, so any number of lookups cost a single git
+    process """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        log.debug("starting cat-file co-process in %s" % self.directory)
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.directory, close_fds=True)
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+            self.process = None
+
+    def read_object(self, ref):
+        """ Returns (hash, type, content) of the object ref points to, or
+        None if it does not exist """
+        with self.lock:
+            # a process started before a fetch may not find the newer
+            # objects, restart it once before declaring them missing
+            for attempt in range(2):
+                if self.process is None or self.process.poll() is not None:
+                    self.start()
+                try:
+                    self.process.stdin.write('%s\n' % ref)
+                    self.process.stdin.flush()
+                    header = self.process.stdout.readline().split()
+                except IOError:
+                    header = []
+                if len(header) == 3:
+                    object_hash, object_type, size = header
+                    content = self.process.stdout.read(int(size))
+                    self.process.stdout.read(1)
+                    return object_hash, object_type, content
+                self.stop()
+        return None
+
+    def get_commit(self, ref):
+        """ Returns a dict with the headers and the message of the commit
+        ref resolves to, or None if it does not exist """
+        git_object = self.read_object('%s^{commit}' % ref)
+        if git_object is None:
+            return None
+        commit_hash, object_type, content = git_object
+        headers, separator, body = content.partition('\n\n')
+        commit = dict()
+        commit['hash'] = commit_hash
+        commit['parents'] = list()
+        commit['body'] = body
+        for header in headers.split('\n'):
+            # multiline headers (signatures) continue with a space
+            if header.startswith(' '):
+                continue
+            key, separator, value = header.partition(' ')
+            if key == 'tree':
+                commit['tree'] = value
+            elif key == 'parent':
+                commit['parents'].append(value)
+            elif key == 'author' or key == 'committer':
+                identity, timestamp, timezone = value.rsplit(' ', 2)
+                commit[key] = identity
+                commit['%s-date' % key] = timestamp
+        return commit
@@ -0,0 +1,152 @@
+import json
+import os
+import subprocess
+import threading
+from ..colorlog import log
+
+
+class CommitIndex(object):
+    """ Persistent index of the commits in some branches, by author and
+    author date and by patch-id. Indexes are built with a single walk of
+    the branch history the first time, then only the commits added since
+    the last indexed tip are walked. A branch whose previous tip is no
+    longer an ancestor (a rewritten branch) is indexed again from scratch.
+
+    The patch-id of every commit seen, indexed or looked up, is kept too,
+    so it is computed once for all the runs """
+
+    state_name = 'commit-index.json'
+    patch_ids_state_name = 'patch-ids.json'
+
+    # maximum number of commits passed to a single git log
+    patch_ids_chunk_size = 500
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.branches = None
+        self.known_patch_ids = None
+        self.lock = threading.Lock()
+
+    def load_json(self, name):
+        try:
+            with open(self.repo.state_path(name)) as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError):
+            return dict()
+
+    def save_json(self, name, data):
+        state_path = self.repo.state_path(name)
+        with open(state_path + '.new', 'w') as state_file:
+            json.dump(data, state_file)
+        os.rename(state_path + '.new', state_path)
+
+    def load(self):
+        self.branches = self.load_json(self.state_name)
+        self.known_patch_ids = self.load_json(self.patch_ids_state_name)
+
+    def save(self):
+        self.save_json(self.state_name, self.branches)
+        self.save_json(self.patch_ids_state_name, self.known_patch_ids)
+
+    def author_key(self, author, date):
+        # keys are read back from json as unicode
+        key = '%s\t%s' % (author, date)
+        if type(key) is str:
+            key = key.decode('utf-8', 'replace')
+        return key
+
+    def read_patch_ids(self, *log_options):
+        """ Returns (commit, patch-id) pairs of the commits selected by
+        log_options, computed by a single git log | git patch-id pipeline """
+        log_process = subprocess.Popen(['git', 'log', '-p', '--no-merges', '--no-color', '--format=%H'] + list(log_options), stdout=subprocess.PIPE, cwd=self.repo.directory)
+        patch_id_process = subprocess.Popen(['git', 'patch-id', '--stable'], stdin=log_process.stdout, stdout=subprocess.PIPE, cwd=self.repo.directory)
+        log_process.stdout.close()
+        output = patch_id_process.communicate()[0]
+        log_process.wait()
+        patch_ids = list()
+        for line in output.split('\n'):
+            if line:
+                patch_id, commit = line.split(' ')
+                patch_ids.append((commit, patch_id))
+        return patch_ids
+
+    def update(self, ref):
+        """ Brings the index of ref up to date with its current tip """
+        if self.branches is None:
+            self.load()
+        tip = self.repo.get_revision(ref)
+        if tip is None:
+            return None
+        branch = self.branches.get(ref)
+        if branch is not None and branch['tip'] == tip:
+            return branch
+        if branch is not None and self.repo.git('merge-base', '--is-ancestor', branch['tip'], tip).returncode == 0:
+            interval = '%s..%s' % (branch['tip'], tip)
+            log.info("Updating commit index of %s with %s" % (ref, interval))
+        else:
+            interval = tip
+            branch = {'authors': dict(), 'patch-ids': dict()}
+            log.info("Building commit index of %s" % ref)
+
+        # commits are listed newest first, newer commits go in front of
+        # the ones already indexed
+        authors = dict()
+        for line in self.repo.git_lines('log', '--format=%H%x00%an <%ae>%x00%at', interval):
+            commit, author, date = line.split('\x00')
+            authors.setdefault(self.author_key(author, date), list()).append(commit)
+        for key in authors:
+            branch['authors'][key] = authors[key] + branch['authors'].get(key, list())
+
+        patch_ids = dict()
+        for commit, patch_id in self.read_patch_ids(interval):
+            patch_ids.setdefault(patch_id, list()).append(commit)
+            self.known_patch_ids[commit] = patch_id
+        for patch_id in patch_ids:
+            branch['patch-ids'][patch_id] = patch_ids[patch_id] + branch['patch-ids'].get(patch_id, list())
+
+        branch['tip'] = tip
+        self.branches[ref] = branch
+        self.save()
+        return branch
+
+    def find_by_author(self, ref, author, date, exclude=None):
+        """ Returns the commits in ref with the given author and author date,
+        newest first. Commits reachable from exclude are left out """
+        with self.lock:
+            branch = self.update(ref)
+        if branch is None:
+            return list()
+        commits = branch['authors'].get(self.author_key(author, date), list())
+        if exclude is not None:
+            commits = [commit for commit in commits if self.repo.git('merge-base', '--is-ancestor', commit, exclude).returncode != 0]
+        return [str(commit) for commit in commits]
+
+    def find_by_patch_id(self, ref, patch_id, exclude=None):
+        """ Returns the commits in ref introducing the same change as
+        patch_id, newest first. Commits reachable from exclude are left out """
+        with self.lock:
+            branch = self.update(ref)
+        if branch is None:
+            return list()
+        commits = branch['patch-ids'].get(patch_id, list())
+        if exclude is not None:
+            commits = [commit for commit in commits if self.repo.git('merge-base', '--is-ancestor', commit, exclude).returncode != 0]
+        return [str(commit) for commit in commits]
+
+    def patch_ids(self, commits):
+        """ Returns the commit -> patch-id map of commits. Only the commits
+        never seen before are passed to git patch-id, all together. Commits
+        without changes, like merges, have no patch-id """
+        with self.lock:
+            if self.branches is None:
+                self.load()
+            missing = [commit for commit in commits if commit not in self.known_patch_ids]
+            for index in range(0, len(missing), self.patch_ids_chunk_size):
+                chunk = missing[index:index + self.patch_ids_chunk_size]
+                for commit in chunk:
+                    self.known_patch_ids[commit] = None
+                for commit, patch_id in self.read_patch_ids('--no-walk=unsorted', *chunk):
+                    self.known_patch_ids[commit] = patch_id
+            if missing:
+                self.save()
+            return dict((commit, self.known_patch_ids[commit]) for commit in commits)
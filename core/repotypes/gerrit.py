@@ -1,54 +1,98 @@
 # Performs sanity check for midstream
 import json
 import pprint
+import time
+from multiprocessing.pool import ThreadPool
 from ..colorlog import log
 from shellcommand import shell
+from sshtransport import SSHTransport
 from ..datastructures import Change
+from ..exceptions import QueryError
 from collections import OrderedDict
 
 
 class Gerrit(object):
 
+    # maximum number of search terms in a single query, long lists of
+    # values are split in multiple queries to stay below gerrit limits
+    query_chunk_size = 100
+    # concurrent reviews, below the default MaxSessions of sshd
+    review_pool_size = 8
+
     def __init__(self, name, host, project_name):
         self.host = host
         self.name = name
         self.project_name = project_name
         self.url = "ssh://%s/%s" % (host, project_name)
-
-    def query_changes_json(self, query, comments=False):
+        self.transport = SSHTransport.get(host)
+        # local repository and its fetches, set when the remote is added to it
+        self.directory = None
+        self.fetches = None
+
+    def query_changes_json(self, query, comments=False, limit=None):
+        """ Returns the changes matching query. Raises QueryError if gerrit
+        cannot be queried, so a failure is never taken for no results """
         changes_infos = list()
-        cmd = shell('ssh %s gerrit query --comments --current-patch-set --format json %s' % (self.host,query))
-        log.debug(pprint.pformat(cmd.output))
-        for change_json in cmd.output:
-            if change_json !='':
-                change = json.loads(change_json)
-                if "type" not in change or (change['type'] != 'stats' and change['type'] != 'error'):
-                    changes_infos.append(change)
+        start = 0
+        more_changes = True
+        if limit:
+            query = '%s limit:%d' % (query, limit)
+        # follow pagination until gerrit reports no more changes
+        while more_changes:
+            more_changes = False
+            cmd = shell(self.transport.command('gerrit query --comments --current-patch-set --format json --start %d %s' % (start, query)))
+            log.debug(pprint.pformat(cmd.output))
+            if cmd.returncode != 0:
+                raise QueryError("gerrit query on %s failed: %s" % (self.host, ' '.join(cmd.errors)))
+            rows = 0
+            for change_json in cmd.output:
+                if change_json !='':
+                    change = json.loads(change_json)
+                    if "type" not in change or (change['type'] != 'stats' and change['type'] != 'error'):
+                        changes_infos.append(change)
+                        rows += 1
+                    elif change['type'] == 'error':
+                        raise QueryError("gerrit query on %s failed: %s" % (self.host, change.get('message')))
+                    elif change['type'] == 'stats' and change.get('moreChanges'):
+                        more_changes = rows > 0 and not limit
+            start += rows
 
         log.debug("end query json")
         return changes_infos
 
     def approve_change(self, number, patchset):
-        shell('ssh %s gerrit review --code-review 2 --verified 1 %s,%s' % (self.host, number, patchset))
+        shell(self.transport.command('gerrit review --code-review 2 --verified 1 %s,%s' % (number, patchset)))
 
     def reject_change(self, number, patchset):
-        shell('ssh %s gerrit review --code-review -2 --verified -1 %s,%s' % (self.host, number, patchset))
+        shell(self.transport.command('gerrit review --code-review -2 --verified -1 %s,%s' % (number, patchset)))
 
     def submit_change(self, number, patchset):
-        shell('ssh %s gerrit review --publish --project %s %s,%s' % (self.host, self.project_name, number, patchset))
-        shell('ssh %s gerrit review --submit --project %s %s,%s' % (self.host, self.project_name, number, patchset))
-        cmd = shell('ssh %s gerrit query --format json "change:%s AND status:merged"' % (self.host, number))
-        if cmd.output[:-1]:
-            return True
+        shell(self.transport.command('gerrit review --publish --project %s %s,%s' % (self.project_name, number, patchset)))
+        shell(self.transport.command('gerrit review --submit --project %s %s,%s' % (self.project_name, number, patchset)))
+        try:
+            if self.query_changes_json('"change:%s AND status:merged"' % number):
+                return True
+        except QueryError, e:
+            log.error(e)
         return False
 
     def publish_change(self, number, patchset):
-        shell('ssh %s gerrit review --publish --project %s %s,%s' % (self.host, self.project_name, number, patchset))
+        shell(self.transport.command('gerrit review --publish --project %s %s,%s' % (self.project_name, number, patchset)))
 
     def abandon_change(self, number, patchset):
-        shell('ssh %s gerrit review --abandon --project %s %s,%s' % (self.host, self.project_name, number, patchset))
-
-    def upload_change(self, branch, topic, reviewers=None, successremove=True):
+        shell(self.transport.command('gerrit review --abandon --project %s %s,%s' % (self.project_name, number, patchset)))
+
+    def upload_change(self, branch, topic, reviewers=None, successremove=True, refspecs=None):
+        if refspecs:
+            # other refspecs go before the change, in a push of their own:
+            # gerrit needs the destination branch to exist and does not
+            # accept branches and changes in the same push
+            cmd = shell('git push %s %s' % (self.name, ' '.join(refspecs)), cwd=self.directory)
+            if self.fetches:
+                self.fetches.invalidate(self.name)
+            if cmd.returncode != 0:
+                log.error("Unable to push %s before uploading the change" % ' '.join(refspecs))
+                return None
         command = 'git push %s HEAD:refs/drafts/%s/%s' % (self.name, branch, topic)
         if reviewers:
             command = "%s%%" % command
@@ -57,22 +101,28 @@ class Gerrit(object):
             command.rstrip(',')
 
         # FIXME: check upload results in another way
-        shell('git checkout %s' % branch)
+        shell('git checkout %s' % branch, cwd=self.directory)
         #cmd = shell('git review -D -r %s -t "%s" %s' % (self.name, topic, branch))
         #for line in cmd.output:
         #    if 'Nothing to do' in line:
         #        log.debug("trying alternative upload method")
         #        shell("git push %s HEAD:refs/drafts/%s/%s" % (self.name, branch, topic))
         #        break
-        shell(command)
-        cmd = shell('ssh %s gerrit query --current-patch-set --format json "topic:%s AND status:open"' % (self.host, topic))
-        shell('git checkout parking')
-        log.debug(pprint.pformat(cmd.output))
-        if not cmd.output[:-1] and successremove:
-            shell('git push replica :%s' % branch)
+        shell(command, cwd=self.directory)
+        if self.fetches:
+            self.fetches.invalidate(self.name)
+        try:
+            changes_infos = self.query_changes_json('"topic:%s AND status:open"' % topic)
+        except QueryError, e:
+            # the change may be there, the branch is not removed
+            log.error(e)
+            shell('git checkout parking', cwd=self.directory)
             return None
-        gerrit_infos = json.loads(cmd.output[:-1][0])
-        infos = self.normalize_infos(gerrit_infos)
+        shell('git checkout parking', cwd=self.directory)
+        if not changes_infos and successremove:
+            shell('git push replica :%s' % branch, cwd=self.directory)
+            return None
+        infos = self.normalize_infos(changes_infos[0])
         return infos
 
     def comment_change(self, number, patchset, comment_message, verified=None, code_review=None):
@@ -84,16 +134,39 @@ class Gerrit(object):
         if verified:
             review_input['labels']['Verified'] = verified
 
-        json_input = json.dumps(review_input, ensure_ascii=False)
+        self.review_change(number, patchset, review_input)
 
-        cmd = shell("echo '%s' | ssh %s gerrit review --json %s,%s" % (json_input, self.host, number, patchset))
+    def review_change(self, number, patchset, review_input):
+        json_input = json.dumps(review_input, ensure_ascii=False)
 
-    def get_query_string(self, criteria, ids, branch=None, search_merged=True):
+        cmd = shell(self.transport.command('gerrit review --json %s,%s' % (number, patchset)), stdin=json_input)
+        return cmd.returncode == 0
+
+    def review_changes(self, reviews):
+        """ Posts a list of (number, patchset, review_input) reviews, on
+        concurrent sessions of the shared connection. Returns the outcome
+        of each review by change number """
+        results = dict()
+        if not reviews:
+            return results
+        pool = ThreadPool(min(self.review_pool_size, len(reviews)))
+        try:
+            outcomes = pool.map(lambda review: self.review_change(*review), reviews)
+        finally:
+            pool.close()
+            pool.join()
+        for review, outcome in zip(reviews, outcomes):
+            results[review[0]] = outcome
+        return results
+
+    def get_query_string(self, criteria, ids, branch=None, search_merged=True, search_abandoned=False):
         query_string = '\(%s:%s' % (criteria, ids[0])
         for change in ids[1:]:
             query_string = query_string + " OR %s:%s" % (criteria,change)
 #        uncomment this below and remove the if else block
-        query_string = query_string + "\) AND project:%s AND NOT status:abandoned" % (self.project_name)
+        query_string = query_string + "\) AND project:%s" % (self.project_name)
+        if not search_abandoned:
+            query_string = query_string + " AND NOT status:abandoned"
         if not search_merged:
             query_string = query_string + " AND NOT status:merged"
 #        if self.name == 'original':
@@ -126,6 +199,7 @@ class Gerrit(object):
         infos['number'] = gerrit_infos['number']
         infos['status'] = gerrit_infos['status']
         infos['url'] = gerrit_infos['url']
+        infos['last-updated'] = gerrit_infos.get('lastUpdated')
         infos['comments'] = None
         if 'comments' in gerrit_infos:
             infos['comments'] = gerrit_infos['comments']
@@ -148,18 +222,44 @@ class Gerrit(object):
 
         return infos
 
-    def get_changes_data(self, search_values, search_field='change', results_key='id', branch=None, sort_key='number', search_merged=True):
+    def get_changes_infos(self, search_values, search_field='change', branch=None, search_merged=True, search_abandoned=False):
+        """ Returns the normalized infos of every change matching any of
+        search_values, more changes may match the same value """
         if type(search_values) is str or type(search_values) is unicode:
             search_values = [search_values]
 
-        query_string = self.get_query_string(search_field, search_values, branch=branch, search_merged=search_merged)
-        changes_data = self.query_changes_json(query_string)
-
-        changes_data.sort(key=lambda data: data[sort_key])
+        changes_data = list()
+        for index in range(0, len(search_values), self.query_chunk_size):
+            chunk = search_values[index:index + self.query_chunk_size]
+            query_string = self.get_query_string(search_field, chunk, branch=branch, search_merged=search_merged, search_abandoned=search_abandoned)
+            changes_data.extend(self.query_changes_json(query_string))
         log.debugvar('changes_data')
+
+        return [self.normalize_infos(gerrit_data) for gerrit_data in changes_data]
+
+    def get_updated_changes_infos(self, since):
+        """ Returns the normalized infos of every change of the project
+        updated since the day since, abandoned ones included """
+        changes_data = self.query_changes_json("'project:%s AND after:%s'" % (self.project_name, since))
+        return [self.normalize_infos(gerrit_data) for gerrit_data in changes_data]
+
+    def updated_since(self, timestamp, margin=60):
+        """ Returns True if any change of the project was updated after
+        timestamp, with a margin for the clock of the gerrit host. A single
+        change is requested. A failed query counts as an update """
+        age = int(time.time() - timestamp) + margin
+        try:
+            return bool(self.query_changes_json("'project:%s AND -age:%ds'" % (self.project_name, age), limit=1))
+        except QueryError, e:
+            log.error(e)
+            return True
+
+    def get_changes_data(self, search_values, search_field='change', results_key='id', branch=None, sort_key='number', search_merged=True):
+        changes_infos = self.get_changes_infos(search_values, search_field=search_field, branch=branch, search_merged=search_merged)
+
+        changes_infos.sort(key=lambda infos: infos[sort_key])
         data = OrderedDict()
-        for gerrit_data in changes_data:
-            norm_data = self.normalize_infos(gerrit_data)
+        for norm_data in changes_infos:
             data[norm_data[results_key]] = norm_data
 
         # fallback to local tracked repo
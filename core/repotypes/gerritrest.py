@@ -0,0 +1,176 @@
+import base64
+import calendar
+import httplib
+import json
+import netrc
+import shlex
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from ..colorlog import log
+from ..exceptions import QueryError
+from gerrit import Gerrit
+
+
+class GerritREST(Gerrit):
+    """ Gerrit remote using the REST API on a keep-alive http connection
+    instead of the ssh command line. Git operations still go through ssh.
+    Changes are converted to the same format of ssh queries, so they are
+    normalized in the same way """
+
+    page_size = 250
+    query_options = ['CURRENT_REVISION', 'CURRENT_COMMIT', 'MESSAGES', 'DETAILED_LABELS', 'DETAILED_ACCOUNTS']
+
+    def __init__(self, name, host, project_name, rest_url):
+        super(GerritREST, self).__init__(name, host, project_name)
+        self.rest_url = rest_url.rstrip('/')
+        url = urlparse.urlsplit(self.rest_url)
+        self.rest_scheme = url.scheme
+        self.rest_netloc = url.netloc
+        self.rest_path = url.path
+        self.headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json; charset=UTF-8',
+        }
+        # authenticated requests use credentials from ~/.netrc
+        try:
+            credentials = netrc.netrc().authenticators(url.hostname)
+        except (IOError, netrc.NetrcParseError):
+            credentials = None
+        if credentials:
+            login, account, password = credentials
+            self.rest_path = self.rest_path + '/a'
+            self.headers['Authorization'] = 'Basic %s' % base64.b64encode('%s:%s' % (login, password))
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.rest_scheme == 'https':
+            self.connection = httplib.HTTPSConnection(self.rest_netloc)
+        else:
+            self.connection = httplib.HTTPConnection(self.rest_netloc)
+
+    def request(self, method, path, data=None):
+        """ Sends a request on the persistent connection, returns the
+        decoded json response or None on errors """
+        body = None
+        if data is not None:
+            body = json.dumps(data)
+        with self.lock:
+            for attempt in range(2):
+                if self.connection is None:
+                    self.connect()
+                try:
+                    self.connection.request(method, self.rest_path + path, body, self.headers)
+                    response = self.connection.getresponse()
+                    content = response.read()
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    # server may have closed an idle connection, retry once
+                    self.connection.close()
+                    self.connection = None
+                    if attempt:
+                        log.error("gerrit %s %s failed: %s" % (method, path, e))
+                        return None
+        if response.status >= 400:
+            log.error("gerrit %s %s failed with status %d: %s" % (method, path, response.status, content))
+            return None
+        # strip gerrit XSSI protection prefix
+        if content.startswith(")]}'"):
+            content = content[4:]
+        if not content.strip():
+            return dict()
+        return json.loads(content)
+
+    def rest_timestamp(self, date):
+        return calendar.timegm(time.strptime(date[:19], '%Y-%m-%d %H:%M:%S'))
+
+    def ssh_infos(self, change):
+        """ Converts a rest ChangeInfo to the format of ssh query results """
+        infos = dict()
+        infos['id'] = change['change_id']
+        infos['number'] = str(change['_number'])
+        infos['project'] = change['project']
+        infos['branch'] = change['branch']
+        infos['status'] = change['status']
+        infos['url'] = '%s/%s' % (self.rest_url, change['_number'])
+        infos['lastUpdated'] = self.rest_timestamp(change['updated'])
+        if 'topic' in change:
+            infos['topic'] = change['topic']
+        infos['comments'] = list()
+        for message in change.get('messages', []):
+            comment = dict()
+            comment['timestamp'] = self.rest_timestamp(message['date'])
+            comment['reviewer'] = message.get('author', {})
+            comment['message'] = message['message']
+            infos['comments'].append(comment)
+        revision = change['revisions'][change['current_revision']]
+        infos['commitMessage'] = revision['commit']['message']
+        patchset = dict()
+        patchset['number'] = str(revision['_number'])
+        patchset['revision'] = change['current_revision']
+        patchset['parents'] = [parent['commit'] for parent in revision['commit']['parents']]
+        approvals = list()
+        for label in change.get('labels', {}):
+            for vote in change['labels'][label].get('all', []):
+                if vote.get('value'):
+                    approvals.append({'type': label, 'value': str(vote['value']), 'by': vote})
+        if approvals:
+            patchset['approvals'] = approvals
+        infos['currentPatchSet'] = patchset
+        return infos
+
+    def query_changes_json(self, query, comments=False, limit=None):
+        # queries are written for the ssh command line, remove shell quoting
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        query = ' '.join(shlex.split(query))
+        changes_infos = list()
+        start = 0
+        more_changes = True
+        while more_changes:
+            params = [('q', query), ('n', limit or self.page_size), ('S', start)] + [('o', option) for option in self.query_options]
+            changes = self.request('GET', '/changes/?%s' % urllib.urlencode(params))
+            if changes is None:
+                raise QueryError("gerrit query on %s failed" % self.rest_url)
+            if not changes:
+                break
+            for change in changes:
+                changes_infos.append(self.ssh_infos(change))
+            more_changes = changes[-1].get('_more_changes', False) and not limit
+            start += len(changes)
+
+        log.debug("end query json")
+        return changes_infos
+
+    def review_change(self, number, patchset, review_input):
+        return self.request('POST', '/changes/%s/revisions/%s/review' % (number, patchset), review_input) is not None
+
+    def review_changes(self, reviews):
+        """ Posts all the reviews on the same connection, one request per
+        change, gerrit has no batch review endpoint """
+        results = dict()
+        for number, patchset, review_input in reviews:
+            results[number] = self.review_change(number, patchset, review_input)
+        return results
+
+    def approve_change(self, number, patchset):
+        self.review_change(number, patchset, {'labels': {'Code-Review': 2, 'Verified': 1}})
+
+    def reject_change(self, number, patchset):
+        self.review_change(number, patchset, {'labels': {'Code-Review': -2, 'Verified': -1}})
+
+    def submit_change(self, number, patchset):
+        self.publish_change(number, patchset)
+        submitted = self.request('POST', '/changes/%s/revisions/%s/submit' % (number, patchset), {})
+        if submitted and submitted.get('status') == 'MERGED':
+            return True
+        return False
+
+    def publish_change(self, number, patchset):
+        self.request('POST', '/changes/%s/publish' % number, {})
+
+    def abandon_change(self, number, patchset):
+        self.request('POST', '/changes/%s/abandon' % number, {})
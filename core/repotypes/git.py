@@ -1,139 +1,370 @@
-import difflib
-import hashlib
+import copy
 import sys
 import os
 import tempfile
 import yaml
 import shutil
+import subprocess
 import re
+import tarfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from ..utils import *
-from shellcommand import shell
+from shellcommand import shell, run, stream
+from catfile import CatFile
+from commitindex import CommitIndex
+from recombinationstore import RecombinationStore
 from ..datastructures import Change, EvolutionDiversityRecombination, OriginalDiversityRecombination, ReplicaMutationRecombination, Recombination
 from gerrit import Gerrit
+from gerritrest import GerritREST
+from sshtransport import SSHTransport
 from ..colorlog import log, logsummary
-from ..exceptions import RecombinationCanceledError, RecombinationFailed, RemoteFetchError
+from ..exceptions import PushError, QueryError, RecombinationCanceledError, RecombinationFailed, RemoteFetchError
 from collections import OrderedDict
 
 
+class Fetches(object):
+    """ Records the fetches performed during a run, so a remote is not
+    fetched again until something is pushed to it """
+
+    def __init__(self):
+        self.fresh = set()
+        self.lock = threading.Lock()
+
+    def is_fresh(self, remote_name, refspec):
+        with self.lock:
+            return (remote_name, refspec) in self.fresh
+
+    def done(self, remote_name, refspec):
+        with self.lock:
+            self.fresh.add((remote_name, refspec))
+
+    def invalidate(self, remote_name):
+        with self.lock:
+            self.fresh = set([fetch for fetch in self.fresh if fetch[0] != remote_name])
+
+    def reset(self):
+        """ Starts a new run """
+        with self.lock:
+            self.fresh = set()
+
+
 class Git(object):
+    """ Local git repository. Every command carries the repository directory
+    explicitly, the process current working directory is never changed """
+
+    # maximum number of change refspecs fetched in a single command
+    fetch_changes_chunk_size = 200
+    # margin on the last changes fetch, gerrit searches by day in its own
+    # timezone
+    fetch_changes_margin = 86400
+    # maximum number of refspecs pushed in a single command
+    push_chunk_size = 200
 
     def __init__(self, directory):
         self.directory = directory
         self.remotes = dict()
+        self.objects = CatFile(self.directory)
+        self.fetches = Fetches()
+        self.worktrees_lock = threading.Lock()
         try:
             os.mkdir(self.directory)
         except OSError:
             pass
-        os.chdir(self.directory)
         try:
-            os.stat(".git")
+            os.stat(os.path.join(self.directory, ".git"))
         except OSError:
-            shell('git init')
+            self.shell('git init')
+
+    def shell(self, commandline, **kwargs):
+        return shell(commandline, cwd=self.directory, **kwargs)
+
+    def git(self, *args, **kwargs):
+        """ Runs a git command from a list of arguments, without a shell """
+        return run(['git'] + list(args), cwd=self.directory, **kwargs)
+
+    def git_lines(self, *args):
+        """ Iterates over the output lines of a git command as they come,
+        for commands with outputs too large to hold in logs and lists """
+        return stream(['git'] + list(args), cwd=self.directory)
 
     def get_revision(self, ref):
-        os.chdir(self.directory)
         # works with both tags and branches
-        cmd = shell('git rev-list -n 1 %s' % ref)
-        revision = cmd.output[0].rstrip('\n')
-        return revision
+        commit = self.objects.get_commit(ref)
+        if commit is None:
+            log.error("Revision %s not found" % ref)
+            return None
+        return commit['hash']
+
+    def state_path(self, name):
+        """ Path of a gitnetics state file for this repository """
+        state_dir = os.path.join(self.directory, '.git', 'gitnetics')
+        try:
+            os.mkdir(state_dir)
+        except OSError:
+            pass
+        return os.path.join(state_dir, name)
+
+    def load_state(self, name):
+        try:
+            with open(self.state_path(name)) as state_file:
+                return yaml.safe_load(state_file)
+        except (IOError, yaml.YAMLError):
+            return None
+
+    def save_state(self, name, data):
+        state_path = self.state_path(name)
+        with open(state_path + '.new', 'w') as state_file:
+            yaml.safe_dump(data, state_file, default_flow_style=False)
+        os.rename(state_path + '.new', state_path)
+
+    def fetch(self, remote_name, refspec=None, force=False):
+        if not force and self.fetches.is_fresh(remote_name, refspec):
+            log.debug("%s %s already fetched in this run" % (remote_name, refspec or ''))
+            return True
+        arguments = ['fetch', remote_name]
+        if refspec:
+            arguments.append(refspec)
+        cmd = self.git(*arguments)
+        if cmd.returncode != 0:
+            return False
+        self.fetches.done(remote_name, refspec)
+        return True
+
+    def push(self, remote_name, *refspecs):
+        cmd = self.git('push', remote_name, *refspecs)
+        # remote changed, next fetch must hit the network again
+        self.fetches.invalidate(remote_name)
+        return cmd
 
     def addremote(self, repo, fetch=True):
-        os.chdir(self.directory)
-        cmd = shell('git remote | grep ^%s$' % repo.name)
+        repo.directory = self.directory
+        repo.fetches = self.fetches
+        cmd = self.shell('git remote | grep ^%s$' % repo.name)
         if cmd.returncode != 0:
-            shell('git remote add %s %s' % (repo.name, repo.url))
+            self.shell('git remote add %s %s' % (repo.name, repo.url))
         if fetch:
-            cmd = shell('git fetch %s' % (repo.name))
-            if cmd.returncode != 0:
+            if not self.fetch(repo.name):
                 raise RemoteFetchError
         self.remotes[repo.name] = repo
 
-    def add_gerrit_remote(self, name, location, project_name, fetch=True, fetch_changes=True):
-        repo = Gerrit(name, location, project_name)
+    def add_gerrit_remote(self, name, location, project_name, fetch=True, fetch_changes=True, rest_url=None):
+        if rest_url:
+            repo = GerritREST(name, location, project_name, rest_url)
+        else:
+            repo = Gerrit(name, location, project_name)
         self.addremote(repo, fetch=fetch)
-        repo.local_track = TrackedRepo(name, self.directory, project_name)
+        repo.local_track = TrackedRepo(name, self.directory, project_name, objects=self.objects)
         if fetch_changes:
-            shell('git fetch %s +refs/changes/*:refs/remotes/%s/changes/*' % (name, name))
+            self.fetch_changes(name)
         try:
-            os.stat(".git/hooks/commit-msg")
+            os.stat(os.path.join(self.directory, ".git/hooks/commit-msg"))
         except OSError:
-            shell('scp -p %s:hooks/commit-msg .git/hooks/' % location)
+            self.shell('scp -p %s %s:hooks/commit-msg .git/hooks/' % (SSHTransport.options(), location))
+
+    def fetch_changes(self, remote_name):
+        """ Fetches refs/changes from a gerrit remote. Only the changes
+        updated since the last recorded fetch are requested, all of them on
+        a cold start """
+        refspec = '+refs/changes/*:refs/remotes/%s/changes/*' % remote_name
+        if self.fetches.is_fresh(remote_name, refspec):
+            return True
+        state = self.load_state('changes-fetch.yaml') or dict()
+        fetch_start = int(time.time())
+        if remote_name not in state:
+            log.info("No previous changes fetch recorded for %s, fetching all changes" % remote_name)
+            if not self.fetch(remote_name, refspec):
+                return False
+        else:
+            since = time.strftime('%Y-%m-%d', time.gmtime(state[remote_name] - self.fetch_changes_margin))
+            repo = self.remotes[remote_name]
+            try:
+                changes_infos = repo.query_changes_json("'project:%s AND after:%s'" % (repo.project_name, since))
+            except QueryError, e:
+                # the recorded fetch stays where it was, the window is
+                # requested again next time
+                log.error(e)
+                return False
+            refspecs = list()
+            for change_infos in changes_infos:
+                number = int(change_infos['number'])
+                refspecs.append('+refs/changes/%02d/%d/*:refs/remotes/%s/changes/%02d/%d/*' % (number % 100, number, remote_name, number % 100, number))
+            log.info("Fetching %d changes updated in %s since %s" % (len(refspecs), remote_name, since))
+            for index in range(0, len(refspecs), self.fetch_changes_chunk_size):
+                cmd = self.git('fetch', remote_name, *refspecs[index:index + self.fetch_changes_chunk_size])
+                if cmd.returncode != 0:
+                    return False
+            self.fetches.done(remote_name, refspec)
+        state[remote_name] = fetch_start
+        self.save_state('changes-fetch.yaml', state)
+        return True
 
     def add_git_remote(self, name, location, project_name, fetch=True):
-        repo = RemoteGit(name, location, self.directory, project_name)
+        repo = RemoteGit(name, location, self.directory, project_name, objects=self.objects)
         self.addremote(repo, fetch=fetch)
 
     def list_branches(self, remote_name, pattern=''):
-        os.chdir(self.directory)
-        cmd = shell('git for-each-ref --format="%%(refname)" refs/remotes/%s/%s | sed -e "s/refs\/remotes\/%s\///"' % (remote_name, pattern, remote_name))
-        return cmd.output
+        prefix = 'refs/remotes/%s/' % remote_name
+        cmd = self.git('for-each-ref', '--format=%(refname)', '%s%s' % (prefix, pattern))
+        return [refname[len(prefix):] for refname in cmd.output]
 
     def track_branch(self, branch, remote_branch):
-        os.chdir(self.directory)
-        shell('git checkout parking')
-        shell('git branch --track %s %s' % (branch, remote_branch))
+        self.shell('git checkout parking')
+        self.shell('git branch --track %s %s' % (branch, remote_branch))
 
     def delete_branch(self, branch):
-        os.chdir(self.directory)
-        shell('git checkout parking')
-        shell('git branch -D %s' % branch)
-
-    def delete_remote_branches(self, remote_name, branches):
-        os.chdir(self.directory)
-        for branch in branches:
-            shell('git push %s :%s' % (remote_name,branch))
+        self.shell('git checkout parking')
+        self.shell('git branch -D %s' % branch)
+
+    def delete_remote_branches(self, remote_name, branches, dry_run=False):
+        """ Deletes branches from remote, with a push every push_chunk_size
+        branches. Returns the outcome of each deletion by branch. With
+        dry_run the deletions are only reported """
+        results = dict()
+        branches = sorted(set(branches))
+        if dry_run:
+            for branch in branches:
+                logsummary.info("Would delete %s from %s" % (branch, remote_name))
+            return results
+        for index in range(0, len(branches), self.push_chunk_size):
+            chunk = branches[index:index + self.push_chunk_size]
+            for branch in chunk:
+                results[branch] = False
+            cmd = self.git('push', '--porcelain', remote_name, *[':refs/heads/%s' % branch for branch in chunk])
+            # porcelain lines are "<flag>\t:<ref>\t<summary>", - for deletions
+            for line in cmd.output:
+                fields = line.split('\t')
+                if len(fields) == 3 and fields[1].startswith(':refs/heads/'):
+                    results[fields[1][len(':refs/heads/'):]] = fields[0] == '-'
+        if branches:
+            self.fetches.invalidate(remote_name)
+        failed = [branch for branch in branches if not results[branch]]
+        logsummary.info("Deleted %d of %d branches from %s" % (len(branches) - len(failed), len(branches), remote_name))
+        for branch in failed:
+            logsummary.warning("Unable to delete %s from %s" % (branch, remote_name))
+        return results
 
     def get_commits(self, revision_start, revision_end, first_parent=True, reverse=True, no_merges=False):
-        os.chdir(self.directory)
-        options = ''
-        commit_list = list()
         log.debug("Interval: %s..%s" % (revision_start, revision_end))
 
-        os.chdir(self.directory)
-        shell('git checkout parking')
+        self.shell('git checkout parking')
+        return self.read_commits(revision_start, revision_end, first_parent=first_parent, reverse=reverse, no_merges=no_merges)
+
+    def read_commits(self, revision_start, revision_end, first_parent=True, reverse=True, no_merges=False):
+        # Hash, parents and body of every commit in the interval are read from
+        # a single rev-list stream. Each record is terminated by a record
+        # separator, so the whole interval costs one process instead of
+        # two per commit. Merge commits still recurse in their second parent
+        options = list()
+        commit_list = list()
         if reverse:
-            options = '%s --reverse' % options
+            options.append('--reverse')
         if first_parent:
-            options = '%s --first-parent' % options
+            options.append('--first-parent')
         if no_merges:
-            options = '%s --no-merges' % options
-        cmd = shell('git rev-list %s --pretty="%%H" %s..%s | grep -v ^commit' % (options, revision_start, revision_end))
+            options.append('--no-merges')
+        options.append('--format=%P%n%B%x1e')
+        options.append('%s..%s' % (revision_start, revision_end))
 
-        for commit_hash in cmd.output:
+        for lines in self.rev_list_records(*options):
             commit = dict()
-            commit['hash'] = commit_hash
-            cmd = shell('git show -s --pretty="%%P" %s' % commit_hash)
-            commit['parents'] = cmd.output[0].split(' ')
-            cmd = shell('git show -s --pretty="%%B" %s' % commit_hash)
-            commit['body'] = cmd.output
+            commit['hash'] = lines[0].replace('commit ', '', 1)
+            commit['parents'] = lines[1].split()
+            # bodies never had their blank lines
+            commit['body'] = [line for line in lines[2:] if line]
             if len(commit['parents']) > 1:
-                commit['subcommits'] = self.get_commits(commit['parents'][0], commit['parents'][1], first_parent=False, reverse=False)
+                commit['subcommits'] = self.read_commits(commit['parents'][0], commit['parents'][1], first_parent=False, reverse=False)
 
             commit_list.append(commit)
 
         return commit_list
 
+    def merge_tree(self, ours, theirs):
+        """ Merges two commits in memory, without touching the index and
+        the working tree. Returns the conflicting paths, empty if the merge
+        is clean, or None if git cannot merge in memory (before 2.38) """
+        cmd = self.git('merge-tree', '--write-tree', '--name-only', '--no-messages', ours, theirs)
+        if cmd.returncode == 0:
+            return list()
+        if cmd.returncode == 1:
+            # the first line is the id of the resulting tree
+            return cmd.output[1:]
+        return None
+
+    def cherry_pick_tree(self, onto, pick):
+        """ Cherry-picks in memory, see merge_tree. The pick is merged with
+        a temporary commit having the tree of onto and the parent of the
+        pick as only parent, so the merge base is the parent of the pick
+        as in a cherry-pick """
+        cmd = self.git('commit-tree', '-p', '%s^' % pick, '-m', 'cherry-pick dry run', '%s^{tree}' % onto)
+        if cmd.returncode != 0:
+            return None
+        return self.merge_tree(cmd.output[0], pick)
+
+    def cherry_pick_write_tree(self, onto, pick):
+        """ Cherry-picks in memory like cherry_pick_tree, onto a commit or a
+        tree. Returns the resulting tree, or None if the pick conflicts """
+        cmd = self.git('commit-tree', '-p', '%s^' % pick, '-m', 'cherry-pick dry run', '%s^{tree}' % onto)
+        if cmd.returncode != 0:
+            return None
+        cmd = self.git('merge-tree', '--write-tree', '--no-messages', cmd.output[0], pick)
+        if cmd.returncode != 0:
+            return None
+        return cmd.output[0]
+
+    def rev_list_records(self, *options):
+        # records are streamed as "commit <hash>", "<parents>" and the body
+        # lines up to the record separator. Blank lines are kept, fields are
+        # found by position: root commits have an empty parents line
+        lines = list()
+        for line in self.git_lines('rev-list', *options):
+            if '\x1e' in line:
+                end, separator, line = line.partition('\x1e')
+                if end:
+                    lines.append(end)
+                if lines:
+                    yield lines
+                lines = list()
+                if not line:
+                    continue
+            lines.append(line)
+        if lines:
+            yield lines
+
     def revision_exists(self, remote, revision, branch):
-        cmd = shell("git ")
+        cmd = self.shell("git ")
         return True
 
 class Underlayer(Git):
+    """ Local copy of a project, where recombinations are prepared.
+
+    Thread safety: an Underlayer touches only its own directory and never
+    the process cwd, so Underlayers of different projects can be used
+    concurrently from different threads. A single Underlayer owns a working
+    tree and is not meant to be shared between threads """
 
     def __init__(self, project_name, directory):
         super(Underlayer, self).__init__(directory)
         self.project_name = project_name
-        shell('git config diff.renames copy')
-        shell('git config diff.renamelimit 10000')
-        shell('git config merge.conflictstyle diff3')
+        self.commit_index = CommitIndex(self)
+        self.recombination_store = RecombinationStore(self)
+        # recombination branches are pushed together with the upload
+        self.deferred_push = False
+        self.shell('git config diff.renames copy')
+        self.shell('git config diff.renamelimit 10000')
+        self.shell('git config merge.conflictstyle diff3')
+        # fetches and pushes share the multiplexed gerrit connections
+        self.shell('git config core.sshCommand "ssh %s"' % SSHTransport.options())
         # TODO: remove all local branches
         # git for-each-ref --format="%(refname)" refs/heads | sed -e "s/refs\/heads//"
         # for branch in local_branches:
-        #    shell('git branch -D %s' % branch)
+        #    self.shell('git branch -D %s' % branch)
         self.mirror_remote = None
-        cmd = shell('git checkout parking')
+        cmd = self.shell('git checkout parking')
         if cmd.returncode != 0:
-            shell('git checkout --orphan parking')
-            shell('git commit --allow-empty -a -m "parking"')
+            self.shell('git checkout --orphan parking')
+            self.shell('git commit --allow-empty -a -m "parking"')
         self.branch_maps = dict()
         self.branch_maps['original->replica'] = dict()
         self.branch_maps['patches->replica'] = dict()
@@ -159,10 +390,10 @@ class Underlayer(Git):
         self.branch_maps['target->patches'][target_branch] = patches_branch
 
 
-    def set_original(self, repo_type, location, project_name, fetch=True):
+    def set_original(self, repo_type, location, project_name, fetch=True, rest_url=None):
         self.original_type = repo_type
         if repo_type == 'gerrit':
-            self.add_gerrit_remote('original', location, project_name, fetch=fetch, fetch_changes=False)
+            self.add_gerrit_remote('original', location, project_name, fetch=fetch, fetch_changes=False, rest_url=rest_url)
         elif repo_type == 'git':
             self.add_git_remote('original', location, project_name, fetch=fetch)
         else:
@@ -170,8 +401,8 @@ class Underlayer(Git):
             raise UnknownError
         self.original_remote = self.remotes['original']
 
-    def set_replica(self, location, project_name, fetch=True):
-        self.add_gerrit_remote('replica',  location, project_name, fetch=fetch, fetch_changes=fetch)
+    def set_replica(self, location, project_name, fetch=True, rest_url=None):
+        self.add_gerrit_remote('replica',  location, project_name, fetch=fetch, fetch_changes=fetch, rest_url=rest_url)
         self.replica_remote = self.remotes['replica']
         self.recomb_remote = self.remotes['replica']
         self.patches_remote = self.remotes['replica']
@@ -180,13 +411,12 @@ class Underlayer(Git):
         self.add_git_remote('replica-mirror', project_info['replica']['mirror'], self.replica_project['name'], fetch=False)
         self.mirror_remote = self.remote['replica-mirror']
 
-    def delete_service_branches(self):
+    def delete_service_branches(self, dry_run=False):
         if self.mirror_remote:
             log.info("Deleting recomb branches from mirror for project %s" % self.project_name)
             service_branches = self.list_branches('replica-mirror', pattern='recomb*')
-            self.delete_remote_branches('replica-mirror', service_branches)
-            service_branches = self.list_branches('replica-mirror', pattern='target-*')
-            self.delete_remote_branches('replica-mirror', service_branches)
+            service_branches.extend(self.list_branches('replica-mirror', pattern='target-*'))
+            return self.delete_remote_branches('replica-mirror', service_branches, dry_run=dry_run)
         else:
             log.info("No mirror repository specified for the project")
 
@@ -196,13 +426,10 @@ class Underlayer(Git):
 
         suggested_solution = None
         log.info("Trying to find a possible cause")
-        cmd = shell('git show -s --pretty=format:"%%an <%%ae>" %s' % pick_revision)
-        author = cmd.output[0]
-        cmd = shell('git show -s --pretty=format:"%%at" %s' % pick_revision)
-        date = cmd.output[0]
-        cmd = shell('git log --pretty=raw --author="%s" | grep -B 3 "%s" | grep commit\  | sed -e "s/commit //g"' % (author, date))
-        if cmd.output:
-            suggested_solution = "Commit %s from upstream was already cherry-picked as %s in %s patches branch" % (pick_revision, cmd.output[0], patches_branch)
+        commit = self.objects.get_commit(pick_revision)
+        backports = self.commit_index.find_by_author('replica/%s' % patches_branch, commit['author'], commit['author-date'])
+        if backports:
+            suggested_solution = "Commit %s from upstream was already cherry-picked as %s in %s patches branch" % (pick_revision, backports[0], patches_branch)
 
         return suggested_solution
 
@@ -213,82 +440,72 @@ class Underlayer(Git):
         return re.sub('(Change-Id: .*\n)', '%s\g<1>' % (conflicts_string),commit_message)
 
     def format_patch(self, recombination):
-        shell('git fetch replica +refs/changes/*:refs/remotes/replica/changes/*')
-        cmd = shell('git checkout remotes/replica/changes/%s/%s/%s' % (recombination.number[-2:], recombination.number, recombination.patchset_number))
-        cmd = shell('git show --pretty=format:"" HEAD  --patch-with-stat')
+        self.fetch_changes('replica')
+        cmd = self.shell('git checkout remotes/replica/changes/%s/%s/%s' % (recombination.number[-2:], recombination.number, recombination.patchset_number))
+        cmd = self.shell('git show --pretty=format:"" HEAD  --patch-with-stat')
         diff = '\n'.join(cmd.output)
         if not diff:
             raise Error
         #diff = 'diff --git a/test-requirements.txt b/test-requirements.txt\nindex 509587b..829b6d6 100644\n--- a/test-requirements.txt\n+++ b/test-requirements.txt\n@@ -1,3 +1,4 @@\n+# ifjoweijf\n # The order of packages is significant, because pip processes them in the order\n # of appearance. Changing the order has an impact on the overall integration\n # process, which may cause wedges in the gate later.\n'
-        cmd = shell('git format-patch %s^..%s --stdout' % (recombination.main_source.revision, recombination.main_source.revision))
+        cmd = self.shell('git format-patch %s^..%s --stdout' % (recombination.main_source.revision, recombination.main_source.revision))
         patch = '\n'.join(cmd.output)
         rs = re.search("Subject: \[PATCH\] ", patch)
         mpatch = patch[:rs.end()]
-        cmd = shell('git --version | sed -e "s/git version //"')
+        cmd = self.shell('git --version | sed -e "s/git version //"')
         gitver = cmd.output[0]
         ampatch = mpatch + recombination.backport_change.commit_message + "\n---\n" + diff + "\n--\n%s\n" % gitver
         log.debugvar('ampatch')
-        cmd = shell('git checkout -B %s remotes/replica/%s' % (recombination.backport_change.branch, recombination.backport_change.branch))
-        cmd = shell('git am --abort')
-        cmd = shell('git am', stdin=ampatch)
+        cmd = self.shell('git checkout -B %s remotes/replica/%s' % (recombination.backport_change.branch, recombination.backport_change.branch))
+        cmd = self.shell('git am --abort')
+        cmd = self.shell('git am', stdin=ampatch)
+
+    def push_recombination_ref(self, recombination, revision, branch):
+        """ Creates or replaces branch on replica with revision. With
+        deferred pushes the refspec is only recorded in the recombination,
+        and goes to replica in the same push of its upload """
+        refspec = '+%s:refs/heads/%s' % (revision, branch)
+        if self.deferred_push:
+            log.info("Deferring push of %s to the upload" % branch)
+            recombination.pending_refspecs.append(refspec)
+            return True
+        cmd = self.push('replica', refspec)
+        return cmd.returncode == 0
 
     def cherrypick_recombine(self, recombination, permanent_patches=None):
-        #shell('git fetch replica')
-        #shell('git fetch original')
+        #self.shell('git fetch replica')
+        #self.shell('git fetch original')
 
         pick_revision = recombination.main_source.revision
         merge_revision = recombination.patches_source.revision
 
-        cmd = shell('git branch --list %s' % recombination.branch)
+        cmd = self.shell('git branch --list %s' % recombination.branch)
         if cmd.output:
-            cmd = shell('git branch -D %s' % recombination.branch)
+            cmd = self.shell('git branch -D %s' % recombination.branch)
 
-        cmd = shell('git branch -r --list replica/%s' % recombination.branch)
-        if cmd.output:
-            cmd = shell('git push replica :%s' % recombination.branch)
+        # dry run, conflicting picks are never attempted in the working tree
+        conflicts = self.cherry_pick_tree(merge_revision, pick_revision)
 
-        cmd = shell('git checkout -b %s %s' % (recombination.branch, merge_revision))
+        cmd = self.shell('git checkout -b %s %s' % (recombination.branch, merge_revision))
 
+        # a stale remote branch is replaced
         log.info("Creating remote disposable branch on replica")
-        cmd = shell('git push replica HEAD:%s' % recombination.branch)
+        self.push_recombination_ref(recombination, merge_revision, recombination.branch)
 
-        cmd = shell('git cherry-pick --no-commit %s' % (pick_revision))
-        # if merge fails, push empty change, and comment with git status.
-        # TO FIND existing commit in patches (conflict resolution suggestions)
-        # for commit in $(git rev-list --reverse --max-count 1000 --no-merges remotes/original/master); do AUTHOR=$(git show -s --pretty=format:"%an <%ae>" $commit); DATE=$(git show -s --pretty=format:"%at" $commit); CORRES=$(git log --pretty=raw --author="$AUTHOR" | grep -B 3 "$DATE" | grep commit\  | sed -e "s/commit //g"); if [ ! -z $CORRES ] ; then echo $commit in original/master is present in patches as $CORRES; fi; done
-        if cmd.returncode != 0:
-        #if cmd.returncode == 0:
-            failure_cause = None
+        failed = bool(conflicts)
+        if failed:
+            log.info("Cherry-pick dry run found conflicts, pick not attempted")
+        else:
+            cmd = self.shell('git cherry-pick --no-commit %s' % (pick_revision))
+            if cmd.returncode != 0:
+                failed = True
+                cmd = self.shell('git status --porcelain')
+                conflicts = self.conflicting_paths(cmd.output)
+                self.shell('git cherry-pick --abort')
+
+        if failed:
             log.error("Recombination Failed")
-            cmd = shell('git status --porcelain')
-            status = ''
-            suggested_solution = ''
-            try:
-                if recombination.backport_change.exist_different:
-                    pass
-            except AttributeError:
-                pass
-
-            if failure_cause == "conflict":
-                conflicts = cmd.output
-                recombination.backport_change.commit_message = self.add_conflicts_string(conflicts, recombination.backport_change.commit_message)
-                status = '\n    '.join([''] + conflicts)
-                # TODO: add diff3 conflict blocks to output to status
-                for filestatus in conflicts:
-                    filename = filestatus[2:] # re.sub('^[A-Z]*\ ', '')
-                    with open(filename) as conflict_file:
-                        filecontent = conflict_file.read()
-                    for lineno, line in enum(filecontent.split('\n')):
-                        rs = re.search('^<<<<<<', line)
-                        if rs is not None:
-                            block_start = line
-                        rs = re.search('^>>>>>>', line)
-                        if rs is not None:
-                            block_end = line
-                    block = '\n'.join(filecontent.split('\n')[block_start:block_end])
-                diffs[filename] = block
-                suggested_solution = self.suggest_conflict_solution(recombination)
-            cmd = shell('git cherry-pick --abort')
+            status = '\n    '.join([''] + ['UU %s' % path for path in conflicts or list()])
+            suggested_solution = self.suggest_conflict_solution(recombination)
             recombination.status = "FAILED"
             self.commit_recomb(recombination)
             raise RecombinationFailed(status, suggested_solution)
@@ -298,8 +515,8 @@ class Underlayer(Git):
 
     def merge_recombine(self, recombination):
 
-        shell('git fetch replica')
-        shell('git fetch original')
+        self.fetch('replica')
+        self.fetch('original')
 
         removed_commits = list()
         pick_revision = recombination.main_source.revision
@@ -309,117 +526,215 @@ class Underlayer(Git):
 
         # Branch prep
         # local patches branch
-        shell('git checkout -B recomb_attempt-%s-base %s' % (patches_branch, merge_revision))
+        self.shell('git checkout -B recomb_attempt-%s-base %s' % (patches_branch, merge_revision))
         # local recomb branch
-        cmd = shell('git rev-parse %s~1' % pick_revision)
-        starting_revision = cmd.output[0]
-        shell('git checkout -B %s %s' % (recombination.branch, starting_revision))
-        log.info("Creating remote disposable branch on replica")
-        cmd = shell('git push replica HEAD:%s' % recombination.branch)
-        if cmd.returncode != 0:
-            raise PushError
-
-
-        patches_removal_queue = list()
-
-        merge = shell("git merge --stat --squash --no-commit %s %s" % (pick_revision, merge_revision))
-
-        if merge.returncode != 0:
-            attempt_number = 0
-            patches_base = dict()
-            log.error("first attempt at merge failed")
-            cmd = shell('git status --porcelain')
-            prev_conflict_status = cmd.output
-            cmd = shell('git merge-base %s %s' % (pick_revision, merge_revision))
-            ancestor = cmd.output[0]
-            cmd = shell('git rev-list --reverse --first-parent %s..remotes/replica/%s' % (ancestor, patches_branch))
-            patches_removal_queue = cmd.output
-            for commit in cmd.output:
-                cmd = shell('git show --pretty=format:"" %s' % commit, show_stdout=False )
-                diff = '\n'.join(cmd.output)
-                hash_object = hashlib.sha1(diff)
-                patches_base[hash_object.hexdigest()] = commit
-            if patches_removal_queue:
-               log.warning("attempting automatic resolution")
-            else:
-                log.error("automatic resolution impossible")
+        starting_revision = self.get_revision('%s~1' % pick_revision)
+        self.shell('git checkout -B %s %s' % (recombination.branch, starting_revision))
+
+        # dry run, conflicting merges are not attempted in the working tree
+        conflicts = self.merge_tree(pick_revision, merge_revision)
+        if conflicts:
+            merged = False
+            conflict_status = ['UU %s' % path for path in conflicts]
         else:
-            log.info("Merge successful")
-
+            merge = self.shell("git merge --stat --squash --no-commit %s %s" % (pick_revision, merge_revision))
+            merged = merge.returncode == 0
+            if not merged:
+                cmd = self.shell('git status --porcelain')
+                conflict_status = cmd.output
         retry_branch = None
 
-        while merge.returncode != 0 and patches_removal_queue:
-            attempt_number += 1
-
-            shell('git reset --hard %s' % recombination.branch)
-
-            shell('git checkout recomb_attempt-%s-base' % patches_branch)
-            retry_branch = 'recomb_attempt-%s-retry_%s' % (patches_branch, attempt_number)
-            shell('git checkout -b %s' % (retry_branch))
-            # Rebasing changes all the commits hashes after "commit"
-            next_patch_toremove = patches_removal_queue.pop(0)
-            shell('git rebase -p --onto %s^ %s' % (next_patch_toremove, next_patch_toremove))
-            cmd = shell('git rev-parse %s' % retry_branch)
-            retry_merge_revision = cmd.output[0]
-
-            shell('git checkout %s' % recombination.branch)
-            merge = shell("git merge --stat --squash --no-commit %s %s" % (pick_revision, retry_merge_revision))
-
-            if merge.returncode != 0:
-                log.warning("automatic resolution attempt %d failed" % attempt_number)
-                cmd = shell('git status --porcelain')
-                conflict_status = cmd.output
-                diff = difflib.Differ()
-                same_status = list(diff.compare(prev_conflict_status, conflict_status))
-                if not same_status:
-                    removed_commits.append(next_patch_toremove)
-                    # removing this patch did not solve everything, but did
-                    # something nonetheless, keep it removed and try to remove
-                    # something else too
-                    # change the base, recalculate every patch commit hash since
-                    # rebase changed everything
-                    shell('git branch -D recomb_attempt-%s-base' % patches_branch)
-                    shell('git checkout -B recomb_attempt-%s-base %s' % patches_branch, retry_merge_revision)
-                    cmd = shell('git rev-list --reverse --first-parent %s..%s' % (ancestor, retry_branch))
-                    patches_removal_queue = cmd.output
-                    prev_conflict_status = conflict_status
-                shell('git branch -D %s' % retry_branch)
-            else:
-                logsummary.warning("automatic resolution attempt %d succeeded" % attempt_number)
-                merge_revision = retry_merge_revision
-                removed_commits.append(next_patch_toremove)
+        if not merged:
+            log.error("first attempt at merge failed")
+            isolation = self.isolate_conflicting_patches(recombination, conflict_status)
+            if isolation is not None:
+                removed_commits, retry_branch = isolation
+                merge_revision = self.get_revision(retry_branch)
+                logsummary.warning("automatic resolution succeeded")
                 logsummary.info("removed commits")
                 logsummary.info(removed_commits)
-                logsummary.info("removed commits (commit hash relative to starting patches branch)")
-                logsummary.info('removed_commits_deashed')
-
+                merged = True
+        else:
+            log.info("Merge successful")
 
-        if merge.returncode != 0:
+        if not merged:
             logsummary.error("automatic resolution failed")
-            shell('git push replica :%s' % recombination.branch)
         else:
             logsummary.info("Recombination successful")
+            log.info("Creating remote disposable branch on replica")
+            if not self.push_recombination_ref(recombination, starting_revision, recombination.branch):
+                raise PushError
             # create new patches-branch
             # TODO: understand if this can be a automatic task or we just notify someone
             if retry_branch:
-                shell('git push replica :%s' % patches_branch)
-                shell('git push replica %s:refs/heads/%s' % (retry_branch, patches_branch))
-                shell('git branch -D %s' % retry_branch)
+                if self.deferred_push:
+                    # a forced update replaces the branch in the upload push
+                    self.push_recombination_ref(recombination, self.get_revision(retry_branch), patches_branch)
+                else:
+                    self.push('replica', ':%s' % patches_branch)
+                    self.push('replica', '%s:refs/heads/%s' % (retry_branch, patches_branch))
+                self.shell('git branch -D %s' % retry_branch)
             recombination.removed_patches_commits = removed_commits
 
             recombination.status = "SUCCESSFUL"
             self.commit_recomb(recombination)
 
             # Create target branch replacement for this recombination
-            shell('git checkout -B %s %s' % (target_replacement_branch, starting_revision))
-            cmd = shell("git merge --log --no-edit %s %s" % (pick_revision, merge_revision))
+            self.shell('git checkout -B %s %s' % (target_replacement_branch, starting_revision))
+            cmd = self.shell("git merge --log --no-edit %s %s" % (pick_revision, merge_revision))
             if cmd.returncode == 0:
-                shell('git push replica HEAD:%s' % target_replacement_branch)
+                self.push_recombination_ref(recombination, self.get_revision(target_replacement_branch), target_replacement_branch)
+
+        self.shell('git checkout parking')
+        #self.shell('git branch -D %s' % recombination_branch)
+        self.shell('git branch -D recomb_attempt-%s-base' % patches_branch)
+        self.shell('git branch -D %s' % target_replacement_branch)
+
+    def conflicting_paths(self, status):
+        # unmerged entries only, paths merged cleanly are staged too
+        unmerged = ['DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU']
+        paths = set()
+        for line in status:
+            if line[:2] not in unmerged:
+                continue
+            # renames are reported as "old -> new"
+            for path in line[3:].split(' -> '):
+                paths.add(path.strip('"'))
+        return sorted(paths)
+
+    def rebuild_without_patches(self, patches, removed):
+        """ Rebuilds in memory the first parent history of patches, newest
+        first, without the removed commits. Returns a commit with the
+        resulting tree on top of patches, so its merge base with other
+        branches does not change, or None if the remaining patches do not
+        apply """
+        tree = None
+        for commit in reversed(patches):
+            if commit in removed:
+                if tree is None:
+                    tree = '%s^' % commit
+            elif tree is not None:
+                # older patches are left as they are
+                tree = self.cherry_pick_write_tree(tree, commit)
+                if tree is None:
+                    return None
+        if tree is None:
+            return patches[0]
+        cmd = self.git('commit-tree', '-p', patches[0], '-m', 'patches dry run', '%s^{tree}' % tree)
+        if cmd.returncode != 0:
+            return None
+        return cmd.output[0]
+
+    def merge_without_patches(self, recombination, patches, removed, retry_branch, dry_run=True):
+        """ Rebuilds the patches branch without the removed commits, then
+        tries the merge with the pick. Dry runs do both in memory and need
+        git merge-tree --write-tree, otherwise the patches are rebased in
+        retry_branch and squash merged in the recombination branch. Returns
+        the rebuilt revision if the merge succeeds, None otherwise """
+        if dry_run:
+            revision = self.rebuild_without_patches(patches, removed)
+            if revision is None or self.merge_tree(recombination.main_source.revision, revision):
+                return None
+            return revision
+        self.shell('git reset --hard %s' % recombination.branch)
+        self.shell('git checkout -B %s %s' % (retry_branch, recombination.patches_source.revision))
+        # patches are removed newest first, rebases do not change the hashes
+        # of the older ones
+        for commit in patches:
+            if commit in removed:
+                cmd = self.shell('git rebase --rebase-merges --onto %s^ %s' % (commit, commit))
+                if cmd.returncode != 0:
+                    # later patches depend on the removed one
+                    self.shell('git rebase --abort')
+                    self.shell('git checkout %s' % recombination.branch)
+                    return None
+        revision = self.get_revision(retry_branch)
+        self.shell('git checkout %s' % recombination.branch)
+        merge = self.shell("git merge --stat --squash --no-commit %s %s" % (recombination.main_source.revision, revision))
+        if merge.returncode != 0:
+            return None
+        return revision
 
-        shell('git checkout parking')
-        #shell('git branch -D %s' % recombination_branch)
-        shell('git branch -D recomb_attempt-%s-base' % patches_branch)
-        shell('git branch -D %s' % target_replacement_branch)
+    def minimal_removal(self, merges_without, required, candidates):
+        # delta debugging: the merge succeeds without required + candidates
+        # and fails without required only. Halves that can be removed alone
+        # are followed, otherwise both halves are minimized keeping the
+        # other one removed
+        if len(candidates) == 1:
+            return candidates
+        half = len(candidates) / 2
+        first = candidates[:half]
+        second = candidates[half:]
+        if merges_without(required + first):
+            return self.minimal_removal(merges_without, required, first)
+        if merges_without(required + second):
+            return self.minimal_removal(merges_without, required, second)
+        first = self.minimal_removal(merges_without, required + second, first)
+        second = self.minimal_removal(merges_without, required + first, second)
+        return first + second
+
+    def isolate_conflicting_patches(self, recombination, conflict_status):
+        """ Finds a minimal set of patches whose removal from the patches
+        branch lets the pick merge. The patches touching the conflicting
+        paths are tried first, the whole branch only if they are not enough.
+        Returns the removed commits and the branch with the remaining
+        patches, leaving the successful merge in the working tree, or None """
+        pick_revision = recombination.main_source.revision
+        patches_revision = recombination.patches_source.revision
+        retry_branch = 'recomb_attempt-%s-retry' % recombination.patches_source.branch
+        ancestor = self.git('merge-base', pick_revision, patches_revision).output[0]
+        interval = '%s..%s' % (ancestor, patches_revision)
+        patches = self.git('rev-list', '--first-parent', interval).output
+        if not patches:
+            log.error("automatic resolution impossible")
+            return None
+        paths = self.conflicting_paths(conflict_status)
+        candidates = list()
+        if paths:
+            candidates = self.git('rev-list', '--first-parent', interval, '--', *paths).output
+        if not candidates:
+            candidates = patches
+        # a patch with the same patch-id as the pick, like a backport carried
+        # in the patches branch, is the first removal to try
+        patch_ids = self.commit_index.patch_ids(patches + [pick_revision])
+        duplicates = [commit for commit in patches if patch_ids[commit] and patch_ids[commit] == patch_ids[pick_revision]]
+        log.warning("attempting automatic resolution, %d candidate patches out of %d" % (len(candidates), len(patches)))
+
+        results = dict()
+        attempts = list()
+        start = time.time()
+        # attempts are dry runs when git can merge in memory
+        dry_run = self.merge_tree(pick_revision, patches_revision) is not None
+
+        def merges_without(removed):
+            removed = frozenset(removed)
+            if removed not in results:
+                attempts.append(removed)
+                results[removed] = self.merge_without_patches(recombination, patches, removed, retry_branch, dry_run=dry_run)
+                log.info("automatic resolution attempt %d removing %d patches %s" % (len(attempts), len(removed), "succeeded" if results[removed] else "failed"))
+            return results[removed] is not None
+
+        removed = None
+        if duplicates and merges_without(duplicates):
+            removed = duplicates
+        elif merges_without(candidates):
+            removed = self.minimal_removal(merges_without, list(), candidates)
+        elif len(candidates) < len(patches) and merges_without(patches):
+            removed = self.minimal_removal(merges_without, list(), patches)
+
+        if removed is not None:
+            # leave the working tree and retry branch with the chosen removal
+            if self.merge_without_patches(recombination, patches, frozenset(removed), retry_branch, dry_run=False) is None:
+                # dry runs and the working tree merge may disagree
+                log.error("merge without the chosen patches failed in the working tree")
+                removed = None
+
+        logsummary.info("conflict isolation: %d merge attempts in %.1f seconds" % (len(attempts), time.time() - start))
+        if removed is None:
+            self.shell('git reset --hard %s' % recombination.branch)
+            self.shell('git branch -D %s' % retry_branch)
+            return None
+        return [commit for commit in patches if commit in removed], retry_branch
 
     def commit_recomb(self, recombination):
         pick_revision = recombination.main_source.revision
@@ -436,72 +751,115 @@ class Underlayer(Git):
             commit_message_file.write("Recombination: %s:%s-%s:%s~%s\n\n" % (main_source_name, pick_revision[:6], patches_source_name, merge_revision[:6], main_branch))
             yaml.dump(commit_data, commit_message_file, default_flow_style=False, indent=4, canonical=False, default_style=False)
 
-        cmd = shell("git commit -F %s" % (commit_message_filename))
+        cmd = self.shell("git commit -F %s" % (commit_message_filename))
         # If two changes with the exact content are merged upstream
         # the above command will succeed but nothing will be committed.
         # and recombination upload will fail due to no change.
         # this assures that we will always commit something to upload
         for line in cmd.output:
             if 'nothing to commit' in line or 'nothing added' in line:
-                shell("git commit --allow-empty -F %s" % (commit_message_filename))
+                self.shell("git commit --allow-empty -F %s" % (commit_message_filename))
                 #logsummary.warning('Contents in commit %s have been merged twice in upstream' % pick_revision)
                 break
         os.unlink(commit_message_filename)
 
     def remove_commits(self, branch, removed_commits, remote=''):
-        shell('git branch --track %s%s %s' (remote, branch, branch))
-        shell('git checkout %s' % branch)
+        self.shell('git branch --track %s%s %s' (remote, branch, branch))
+        self.shell('git checkout %s' % branch)
         for commit in removed_commits:
-            cmd = shell('git show -s %s' % commit)
+            cmd = self.shell('git show -s %s' % commit)
             if cmd.output:
-                shell('git rebase -p --onto %s^ %s' % (commit, commit))
+                self.shell('git rebase -p --onto %s^ %s' % (commit, commit))
                 log.info('removed commit %s from branch %s' % (commit, branch))
             else:
                 break
         if remote:
-            shell('git push -f %s HEAD:%s' % (remote, branch))
+            self.push(remote, '+HEAD:%s' % branch)
             log.info('Pushed modified branch on remote')
-        shell('git checkout parking')
+        self.shell('git checkout parking')
 
     def sync_replica(self, replica_branch, revision):
-        os.chdir(self.directory)
-        shell('git fetch replica')
-        shell('git branch --track replica-%s remotes/replica/%s' % (replica_branch, replica_branch))
-        shell('git checkout replica-%s' % replica_branch)
-        cmd = shell('git merge --ff-only %s' % revision)
+        self.fetch('replica')
+        self.shell('git branch --track replica-%s remotes/replica/%s' % (replica_branch, replica_branch))
+        self.shell('git checkout replica-%s' % replica_branch)
+        cmd = self.shell('git merge --ff-only %s' % revision)
         if cmd.returncode != 0:
             log.debug(cmd.output)
             log.critical("Error merging. Exiting")
             raise MergeError
-        cmd = shell('git push replica HEAD:%s' % replica_branch)
+        cmd = self.push('replica', 'HEAD:%s' % replica_branch)
         if cmd.returncode != 0:
             log.debug(cmd.output)
             log.critical("Error pushing the merge. Exiting")
             raise PushError
-        shell('git checkout parking')
-        shell('git branch -D replica-%s' % replica_branch)
+        self.shell('git checkout parking')
+        self.shell('git branch -D replica-%s' % replica_branch)
 
     def update_target_branch(self, target_replacement_branch, target_branch):
-        shell('git fetch replica')
-        shell('git checkout remotes/replica/%s' % (target_replacement_branch))
-        shell('git push -f replica HEAD:%s' % (target_branch))
-        shell('git checkout parking')
-        shell('git push replica :%s ' % target_replacement_branch)
-
-    def fetch_recombinations(self, test_basedir, status, recomb_id=None):
+        self.fetch('replica')
+        self.shell('git checkout remotes/replica/%s' % (target_replacement_branch))
+        self.push('replica', '+HEAD:%s' % target_branch)
+        self.shell('git checkout parking')
+        self.push('replica', ':%s' % target_replacement_branch)
+
+    def export_revision(self, revision, target_dir, export_mode='archive'):
+        """ Materializes the tree of revision in target_dir without touching
+        the working tree. archive mode streams git archive into the
+        directory, worktree mode adds a detached worktree sharing the object
+        store """
+        shutil.rmtree(target_dir, ignore_errors=True)
+        if export_mode == 'worktree':
+            with self.worktrees_lock:
+                self.shell('git worktree prune')
+                cmd = self.shell('git worktree add --detach --force %s %s' % (target_dir, revision))
+            return cmd.returncode == 0
+
+        log.info("Exporting %s to %s" % (revision, target_dir))
+        archive = subprocess.Popen(['git', 'archive', '--format=tar', revision], stdout=subprocess.PIPE, cwd=self.directory)
+        try:
+            tar = tarfile.open(fileobj=archive.stdout, mode='r|')
+            for member in tar:
+                # same content as a copy of the working tree without git files
+                if [part for part in member.name.split('/') if part.startswith('.git')]:
+                    continue
+                tar.extract(member, target_dir)
+            tar.close()
+        except (tarfile.TarError, OSError, IOError), e:
+            log.error("Unable to extract %s: %s" % (revision, e))
+            archive.stdout.close()
+            archive.wait()
+            return False
+        archive.stdout.close()
+        return archive.wait() == 0
+
+    def fetch_recombinations(self, test_basedir, status, recomb_id=None, export_mode='archive', jobs=1):
         untested_recombs = self.recomb_remote.get_untested_recombs_infos(recomb_id=recomb_id)
         dirlist = dict()
-        os.chdir(self.directory)
-        change_dir = os.getcwd()
-        shell('git checkout parking')
+        exports = list()
         for recomb in untested_recombs:
             recomb_dir = "%s/%s/code" % (self.project_name, recomb['number'])
             recomb_branch = 'remotes/%s/changes/%s/%s/%s' % (self.recomb_remote.name, recomb['number'][-2:], recomb['number'], recomb['currentPatchSet']['number'])
-            shell('git checkout %s' % recomb_branch)
-            shutil.rmtree(test_basedir + "/" + recomb_dir, ignore_errors=True)
-            shutil.copytree(change_dir, test_basedir + "/" + recomb_dir, ignore=shutil.ignore_patterns('.git*'))
-            shell('git checkout parking')
-            dirlist[recomb['number']] = recomb_dir
+            exports.append((recomb['number'], recomb_branch, recomb_dir))
+
+        def export(recomb_export):
+            number, recomb_branch, recomb_dir = recomb_export
+            return number, recomb_dir, self.export_revision(recomb_branch, test_basedir + "/" + recomb_dir, export_mode=export_mode)
+
+        if jobs > 1 and len(exports) > 1:
+            pool = ThreadPool(processes=min(jobs, len(exports)))
+            try:
+                results = pool.map(export, exports)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [export(recomb_export) for recomb_export in exports]
+
+        for number, recomb_dir, exported in results:
+            if exported:
+                dirlist[number] = recomb_dir
+            else:
+                log.error("Unable to export recombination %s in %s" % (number, recomb_dir))
         return dirlist
 
     def get_patches_changes(self, patches_branch):
@@ -573,14 +931,68 @@ class Underlayer(Git):
     def get_backport_change():
         pass
 
+    def prefetch_recombination_sources(self, recomb_data, known_changes):
+        """ Resolves the main source and backport changes of the existing
+        recombinations in recomb_data with a query for each branch, instead
+        of a query for each recombination. known_changes are main source
+        changes already resolved. Returns main and backport changes by id """
+        main_ids = dict()
+        backport_ids = dict()
+        for data in recomb_data.values():
+            metadata = data.get('metadata')
+            try:
+                main = metadata['sources']['main']
+                patches_branch = metadata['sources']['patches']['branch']
+            except (KeyError, TypeError):
+                # not parsed yet, the loader will report it
+                continue
+            if main['id'] not in known_changes or known_changes[main['id']].branch != main['branch']:
+                main_ids.setdefault(main['branch'], set()).add(main['id'])
+            if metadata.get('backport-id') is not None:
+                backport_ids.setdefault(patches_branch, set()).add(metadata['backport-id'])
+
+        main_changes = dict(known_changes)
+        for branch in main_ids:
+            main_changes.update(self.original_remote.get_changes(list(main_ids[branch]), branch=branch))
+        backport_changes = dict()
+        for branch in backport_ids:
+            backport_changes.update(self.patches_remote.get_changes(list(backport_ids[branch]), branch=branch))
+        return main_changes, backport_changes
+
+    def find_backport(self, diversity_refname, revision, patch_id, lock_revision):
+        """ Returns the most recent commit in diversity_refname after
+        lock_revision that backports revision, or None """
+        commit = self.objects.get_commit(revision)
+        backports = self.commit_index.find_by_author(diversity_refname, commit['author'], commit['author-date'], exclude=lock_revision)
+        if not backports and patch_id:
+            # backports with a different author date are found by patch-id
+            backports = self.commit_index.find_by_patch_id(diversity_refname, patch_id, exclude=lock_revision)
+        if backports:
+            return backports[0]
+        return None
+
     def get_recombinations_from_original(self, original_branch, original_ids, diversity_refname, replication_strategy, replica_lock):
         patches_branch = self.branch_maps['original->patches'][original_branch]
         diversity_revision = self.get_revision(diversity_refname)
         diversity_change = self.patches_remote.local_track.get_change(diversity_revision, branch=patches_branch)
         recombinations = OrderedDict()
         original_changes = self.original_remote.get_changes(list(original_ids), branch=original_branch)
-        recomb_data = self.recomb_remote.get_changes_data(list(original_ids), search_field='topic', results_key='topic')
-
+        # only the recombinations updated since the last run are queried
+        recomb_data = self.recombination_store.get_changes_data(self.recomb_remote, list(original_ids))
+        main_changes, backport_changes = self.prefetch_recombination_sources(recomb_data, original_changes)
+        if replication_strategy == "lock-and-backports":
+            original_patch_ids = self.commit_index.patch_ids(original_ids.values())
+            lock_revision = self.get_revision(replica_lock)
+            # backports of the changes without a recombination, resolved
+            # all together by commit
+            backport_commits = dict()
+            for change_id in original_ids:
+                if change_id not in recomb_data:
+                    backport_commits[change_id] = self.find_backport(diversity_refname, original_ids[change_id], original_patch_ids[original_ids[change_id]], lock_revision)
+            commit_changes = dict()
+            found_commits = list(set(commit for commit in backport_commits.values() if commit))
+            if found_commits:
+                commit_changes = self.patches_remote.get_changes(found_commits, search_field='commit', results_key='revision')
 
         log.debugvar('original_changes')
         for change_id in original_ids:
@@ -591,9 +1003,23 @@ class Underlayer(Git):
 
             new_recomb = True
             if change_id in recomb_data:
+                # prefetched sources are copied, loaders set their revision
+                resolved = dict()
+                metadata = recomb_data[change_id].get('metadata') or dict()
+                try:
+                    main_id = metadata['sources']['main']['id']
+                    if main_id in main_changes and main_changes[main_id].branch == metadata['sources']['main']['branch']:
+                        resolved['main'] = copy.copy(main_changes[main_id])
+                except (KeyError, TypeError):
+                    pass
+                if metadata.get('backport-id') in backport_changes:
+                    resolved['backport'] = copy.copy(backport_changes[metadata['backport-id']])
                 try:
                     recombination = recomb_class(self, self.recomb_remote)
-                    recombination.load_change_data(recomb_data[change_id], original_remote=self.original_remote, patches_remote=self.patches_remote, diversity_change=diversity_change)
+                    if replication_strategy == "lock-and-backports":
+                        recombination.load_change_data(recomb_data[change_id], original_remote=self.original_remote, patches_remote=self.patches_remote, diversity_change=diversity_change, evolution_change=resolved.get('main'), backport_change=resolved.get('backport'))
+                    else:
+                        recombination.load_change_data(recomb_data[change_id], original_remote=self.original_remote, patches_remote=self.patches_remote, diversity_change=diversity_change, original_change=resolved.get('main'))
                     new_recomb = False
                 except RecombinationCanceledError:
                     del(recombination)
@@ -603,14 +1029,15 @@ class Underlayer(Git):
                 # Set real commit as revision
                 original_changes[change_id].revision = original_ids[change_id]
                 if replication_strategy == "lock-and-backports":
-                    lock_revision = self.get_revision(replica_lock)
-                    cmd = shell('git show -s --pretty=format:"%%an <%%ae>" %s' % original_ids[change_id])
-                    author = cmd.output[0]
-                    cmd = shell('git show -s --pretty=format:"%%at" %s' % original_ids[change_id])
-                    date = cmd.output[0]
-                    cmd = shell('git log --pretty=raw --author="%s" %s..%s | grep -B 3 "%s" | grep commit\  | sed -e "s/commit //g"' % (author, lock_revision, diversity_revision, date))
-                    if cmd.output:
-                        backport_change = self.patches_remote.get_change(cmd.output[0], search_field='commit')
+                    if change_id not in backport_commits:
+                        # a canceled recombination, not looked up above
+                        backport_commits[change_id] = self.find_backport(diversity_refname, original_ids[change_id], original_patch_ids[original_ids[change_id]], lock_revision)
+                    backport_commit = backport_commits[change_id]
+                    if backport_commit:
+                        if backport_commit in commit_changes:
+                            backport_change = commit_changes[backport_commit]
+                        else:
+                            backport_change = self.patches_remote.get_change(backport_commit, search_field='commit')
                         # TODO: evaluate body diff.
                         # if body_diff:
                         #     log.warning ('backport is present but patch differs')
@@ -643,13 +1070,22 @@ class Underlayer(Git):
     def get_recombination(self, recomb_id):
         return self.recomb_remote.get_change(recomb_id)
 
+    def get_recombinations(self, recomb_ids):
+        """ Returns the recombinations by change number, with one query """
+        changes = self.recomb_remote.get_changes([str(recomb_id) for recomb_id in recomb_ids], results_key='number')
+        return dict((str(number), changes[number]) for number in changes)
+
 
 class TrackedRepo(Git):
 
-    def __init__(self, name, directory, project_name):
+    def __init__(self, name, directory, project_name, objects=None):
         self.name = name
         self.directory = directory
         self.project_name = project_name
+        # shares the object reader of the repository it tracks
+        if objects is None:
+            objects = CatFile(self.directory)
+        self.objects = objects
 
     def get_changes_data(self, search_values, search_field='commit', results_key='revision', branch=None):
         if type(search_values) is str or type(search_values) is unicode:
@@ -660,11 +1096,13 @@ class TrackedRepo(Git):
             return None
 
         changes_data = dict()
-        os.chdir(self.directory)
         for revision in search_values:
             infos = {}
-            cmd = shell('git show -s --pretty=format:"%%H %%P" %s' % (revision))
-            infos['id'], infos['parent'] = cmd.output[0].split(' ')[0:2]
+            commit = self.objects.get_commit(revision)
+            infos['id'] = commit['hash']
+            infos['parent'] = ''
+            if commit['parents']:
+                infos['parent'] = commit['parents'][0]
             infos['revision'] = infos['id']
             if not branch:
                 log.error("for git repositories you must specify a branch")
@@ -708,7 +1146,7 @@ class TrackedRepo(Git):
 
 class RemoteGit(TrackedRepo):
 
-    def __init__(self, name, location, directory, project_name):
-        super(RemoteGit, self).__init__(name, directory, project_name)
+    def __init__(self, name, location, directory, project_name, objects=None):
+        super(RemoteGit, self).__init__(name, directory, project_name, objects=objects)
         self.url = "git@%s:%s" % (location, project_name)
 
@@ -0,0 +1,208 @@
+import cPickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from ..colorlog import log
+from ..datastructures import Recombination
+from ..exceptions import DecodeError
+
+
+class RecombinationStore(object):
+    """ Persistent store of the recombinations of a project, by topic.
+
+    Recombinations are queried once, then only the ones gerrit reports as
+    updated since the last run are queried again. Topics without any
+    recombination are remembered too, until a change with that topic shows
+    up among the updated ones. The commit message of every recombination
+    is parsed once for each patchset and its metadata is kept along with
+    the gerrit infos.
+
+    The outcome of the analysis of the comments of each recombination is
+    kept too, so only the comments added since are analyzed """
+
+    state_name = 'recombinations.sqlite'
+
+    # margin on the last sync, gerrit searches by day in its own timezone
+    sync_margin = 86400
+    # topics read in a single select, below the sqlite variables limit
+    select_chunk_size = 500
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is not None:
+            return self.connection
+        # infos and metadata are pickled, json would turn their strings to
+        # unicode and yaml would dump them differently in commit messages
+        self.connection = sqlite3.connect(self.repo.state_path(self.state_name), check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS recombinations (
+                topic TEXT PRIMARY KEY,
+                number INTEGER,
+                type TEXT,
+                status TEXT,
+                recombine_status TEXT,
+                main_revision TEXT,
+                patches_revision TEXT,
+                patchset_revision TEXT,
+                last_updated INTEGER,
+                infos BLOB,
+                metadata BLOB
+            );
+            CREATE TABLE IF NOT EXISTS comments (
+                number INTEGER PRIMARY KEY,
+                processed INTEGER,
+                last_timestamp INTEGER,
+                comments_metadata BLOB,
+                user_requests BLOB
+            );
+            CREATE TABLE IF NOT EXISTS sync (
+                remote TEXT PRIMARY KEY,
+                last_sync INTEGER
+            );
+        ''')
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get_last_sync(self, remote):
+        row = self.connection.execute('SELECT last_sync FROM sync WHERE remote = ?', (remote.name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_last_sync(self, remote, last_sync):
+        self.connection.execute('INSERT OR REPLACE INTO sync (remote, last_sync) VALUES (?, ?)', (remote.name, last_sync))
+
+    def get_row(self, topic):
+        return self.connection.execute('SELECT number, status, patchset_revision, last_updated, metadata FROM recombinations WHERE topic = ?', (topic,)).fetchone()
+
+    def store_missing(self, topic):
+        self.connection.execute('INSERT OR REPLACE INTO recombinations (topic) VALUES (?)', (topic,))
+
+    def store(self, infos):
+        """ Stores the infos of a recombination if they are newer than the
+        stored ones. Of different recombinations with the same topic, an
+        open one is preferred to an abandoned one, then the most recent one """
+        topic = str(infos['topic'])
+        row = self.get_row(topic)
+        if row is not None and row[0] is not None:
+            number, status, patchset_revision, last_updated, metadata = row
+            if number != int(infos['number']):
+                if (status != 'ABANDONED', number) > (infos['status'] != 'ABANDONED', int(infos['number'])):
+                    return
+            elif last_updated == infos['last-updated']:
+                # updates of the same change, abandons too, always replace it
+                return
+            if patchset_revision == infos['patchset_revision']:
+                # same commit message, comments and status may be new
+                metadata = cPickle.loads(str(metadata))
+            else:
+                metadata = None
+        else:
+            metadata = None
+
+        if metadata is None:
+            try:
+                metadata = Recombination.parse_commit_message(infos['commit-message'])
+            except DecodeError:
+                # parsed again and reported when the recombination is loaded
+                metadata = None
+        recomb_type = recombine_status = main_revision = patches_revision = None
+        if metadata is not None:
+            recomb_type = metadata.get('recomb-type')
+            recombine_status = metadata.get('recombine-status')
+            try:
+                main_revision = metadata['sources']['main']['revision']
+                patches_revision = metadata['sources']['patches']['revision']
+            except (KeyError, TypeError):
+                pass
+        self.connection.execute('INSERT OR REPLACE INTO recombinations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (topic, int(infos['number']), recomb_type, infos['status'], recombine_status,
+                                 main_revision, patches_revision, infos['patchset_revision'], infos['last-updated'],
+                                 sqlite3.Binary(cPickle.dumps(infos, cPickle.HIGHEST_PROTOCOL)),
+                                 sqlite3.Binary(cPickle.dumps(metadata, cPickle.HIGHEST_PROTOCOL))))
+
+    def refresh(self, remote):
+        """ Stores again the known recombinations gerrit reports as updated
+        since the last sync """
+        last_sync = self.get_last_sync(remote)
+        if last_sync is None:
+            return 0
+        since = time.strftime('%Y-%m-%d', time.gmtime(last_sync - self.sync_margin))
+        refreshed = 0
+        for infos in remote.get_updated_changes_infos(since):
+            if 'topic' not in infos:
+                continue
+            if self.connection.execute('SELECT 1 FROM recombinations WHERE topic = ?', (str(infos['topic']),)).fetchone() is None:
+                continue
+            self.store(infos)
+            refreshed += 1
+        return refreshed
+
+    def get_changes_data(self, remote, topics):
+        """ Returns the data of the recombinations with the given topics,
+        by topic, like Gerrit.get_changes_data. Each data carries the
+        metadata parsed from its commit message """
+        topics = [str(topic) for topic in topics]
+        with self.lock:
+            self.connect()
+            sync_start = int(time.time())
+            try:
+                refreshed = self.refresh(remote)
+
+                missing = [topic for topic in topics if self.connection.execute('SELECT 1 FROM recombinations WHERE topic = ?', (topic,)).fetchone() is None]
+                if missing:
+                    for topic in missing:
+                        self.store_missing(topic)
+                    for infos in remote.get_changes_infos(missing, search_field='topic', search_abandoned=True):
+                        self.store(infos)
+                self.set_last_sync(remote, sync_start)
+            except Exception:
+                # topics are not known to be missing if gerrit was not asked
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+            log.info("recombination store: %d topics, %d refreshed, %d queried" % (len(topics), refreshed, len(missing)))
+
+            rows = list()
+            for index in range(0, len(topics), self.select_chunk_size):
+                chunk = topics[index:index + self.select_chunk_size]
+                rows.extend(self.connection.execute('SELECT number, infos, metadata FROM recombinations WHERE status != ? AND topic IN (%s)' % ','.join('?' * len(chunk)), ['ABANDONED'] + chunk).fetchall())
+
+        rows.sort()
+        data = OrderedDict()
+        for number, infos, metadata in rows:
+            infos = cPickle.loads(str(infos))
+            infos['metadata'] = cPickle.loads(str(metadata))
+            data[infos['topic']] = infos
+        return data
+
+    def get_comments_analysis(self, number):
+        """ Returns the number of comments analyzed in the change, the
+        timestamp of the last one, the metadata and the user requests found
+        in them, or None if the comments were never analyzed """
+        with self.lock:
+            self.connect()
+            row = self.connection.execute('SELECT processed, last_timestamp, comments_metadata, user_requests FROM comments WHERE number = ?', (int(number),)).fetchone()
+        if row is None:
+            return None
+        processed, last_timestamp, comments_metadata, user_requests = row
+        return processed, last_timestamp, cPickle.loads(str(comments_metadata)), cPickle.loads(str(user_requests))
+
+    def store_comments_analysis(self, number, processed, last_timestamp, comments_metadata, user_requests):
+        with self.lock:
+            self.connect()
+            self.connection.execute('INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?)',
+                                    (int(number), processed, last_timestamp,
+                                     sqlite3.Binary(cPickle.dumps(comments_metadata, cPickle.HIGHEST_PROTOCOL)),
+                                     sqlite3.Binary(cPickle.dumps(user_requests, cPickle.HIGHEST_PROTOCOL))))
+            self.connection.commit()
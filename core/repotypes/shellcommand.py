@@ -1,38 +1,81 @@
+import logging
 import subprocess
-from ..colorlog import log
+import tempfile
+from ..colorlog import log, SUCCESS
 
-def shell(commandline, stdin=None, show_stdout=True, show_stderr=True, remove_blank=True, output_mode="list"):
-    # TODO: implement output_mode = LIST, TEXT, SINGLE_LINE, SINGLE_VALUE
-    process = subprocess.Popen(commandline, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    if stdin is not None:
-        process.stdin.write(stdin)
-    process.output, process.errors = process.communicate()
-    process.output = process.output.split('\n')
-    process.errors = process.errors.split('\n')
+def log_command(process, commandline, show_stdout=True, show_stderr=True):
+    # nothing is formatted when the levels are filtered out
     if process.returncode == 0:
         outlog = log.success
+        outlevel = SUCCESS
     else:
         outlog = log.error
-    log.info("---- executing command: %s" % commandline)
-    log.info("---- stdout:")
-    if show_stdout:
-        for line in process.output:
-            outlog(line)
-    else:
-        outlog("*** Suppressed")
-    log.info("---- stderr:")
-    if show_stderr:
-        for line in process.errors:
-            outlog(line)
-    else:
-        outlog("*** Suppressed")
-    log.info("---- end command")
+        outlevel = logging.ERROR
+    show_info = log.isEnabledFor(logging.INFO)
+    show_output = log.isEnabledFor(outlevel)
+    if show_info:
+        log.info("---- executing command: %s" % commandline)
+        log.info("---- stdout:")
+    if show_output:
+        if show_stdout:
+            for line in process.output:
+                outlog(line)
+        else:
+            outlog("*** Suppressed")
+    if show_info:
+        log.info("---- stderr:")
+    if show_output:
+        if show_stderr:
+            for line in process.errors:
+                outlog(line)
+        else:
+            outlog("*** Suppressed")
+    if show_info:
+        log.info("---- end command")
+
+def communicate(process, commandline, stdin=None, show_stdout=True, show_stderr=True, remove_blank=True):
+    process.output, process.errors = process.communicate(stdin)
+    process.output = process.output.split('\n')
+    process.errors = process.errors.split('\n')
+    log_command(process, commandline, show_stdout=show_stdout, show_stderr=show_stderr)
     if remove_blank:
         # remove blank lines from output for further processing
-        while '' in process.output:
-            process.output.remove('')
-        while '' in process.errors:
-            process.errors.remove('')
+        process.output = [line for line in process.output if line != '']
+        process.errors = [line for line in process.errors if line != '']
     return process
 
+def run(argv, stdin=None, show_stdout=True, show_stderr=True, remove_blank=True, cwd=None):
+    """ Executes argv directly, without an intermediate shell. Returns the
+    process with output and errors split in lines, like shell() """
+    process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    return communicate(process, ' '.join(argv), stdin=stdin, show_stdout=show_stdout, show_stderr=show_stderr, remove_blank=remove_blank)
 
+def stream(argv, cwd=None):
+    """ Executes argv and yields its output one line at a time, without
+    keeping it all in memory. Lines are not logged, only the command and
+    its errors are """
+    if log.isEnabledFor(logging.INFO):
+        log.info("---- streaming command: %s" % ' '.join(argv))
+    # errors go to a file, a full stderr pipe would block the command
+    errors_file = tempfile.TemporaryFile()
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=errors_file, cwd=cwd)
+    try:
+        for line in iter(process.stdout.readline, ''):
+            yield line.rstrip('\n')
+    finally:
+        process.stdout.close()
+        errors_file.seek(0)
+        errors = errors_file.read()
+        errors_file.close()
+        if process.wait() != 0:
+            log.error("---- command failed with status %d: %s" % (process.returncode, ' '.join(argv)))
+            for line in errors.split('\n'):
+                if line:
+                    log.error(line)
+
+def shell(commandline, stdin=None, show_stdout=True, show_stderr=True, remove_blank=True, output_mode="list", cwd=None):
+    # TODO: implement output_mode = LIST, TEXT, SINGLE_LINE, SINGLE_VALUE
+    if type(commandline) is list:
+        return run(commandline, stdin=stdin, show_stdout=show_stdout, show_stderr=show_stderr, remove_blank=remove_blank, cwd=cwd)
+    process = subprocess.Popen(commandline, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=cwd)
+    return communicate(process, commandline, stdin=stdin, show_stdout=show_stdout, show_stderr=show_stderr, remove_blank=remove_blank)
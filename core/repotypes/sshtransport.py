@@ -0,0 +1,88 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from ..colorlog import log
+
+
+class SSHTransport(object):
+    """ Multiplexed ssh connection to a host. A master connection is kept
+    open in background and shared by every command sent to the host, so only
+    the first command pays for the handshake. The control socket path is
+    the same used by git for the repositories, so fetches and pushes share
+    the connection too """
+
+    # seconds the master connection survives after its last use
+    persist = 600
+
+    transports = dict()
+    transports_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host):
+        """ Returns the transport shared by all the users of host """
+        with cls.transports_lock:
+            if host not in cls.transports:
+                cls.transports[host] = cls(host)
+            return cls.transports[host]
+
+    @classmethod
+    def control_dir(cls):
+        control_dir = os.path.join(tempfile.gettempdir(), 'gitnetics-ssh-%d' % os.getuid())
+        try:
+            os.mkdir(control_dir, 0700)
+        except OSError:
+            pass
+        return control_dir
+
+    @classmethod
+    def options(cls):
+        return '-o ControlMaster=auto -o ControlPath=%s/%%C -o ControlPersist=%d' % (cls.control_dir(), cls.persist)
+
+    @classmethod
+    def metrics(cls):
+        """ Returns connections metrics for every host used """
+        with cls.transports_lock:
+            return dict((host, cls.transports[host].host_metrics()) for host in cls.transports)
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.handshake_time = 0.0
+        self.commands = 0
+        self.last_use = None
+
+    def host_metrics(self):
+        return {
+            'connections': self.connections,
+            'handshake-time': self.handshake_time,
+            'commands': self.commands,
+        }
+
+    def connect(self):
+        """ Makes sure a master connection is alive """
+        with self.lock:
+            now = time.time()
+            self.commands += 1
+            # a master used recently is still persisting
+            if self.last_use is not None and now - self.last_use < self.persist / 2:
+                self.last_use = now
+                return
+            base = ['ssh'] + self.options().split()
+            with open(os.devnull, 'w') as devnull:
+                if subprocess.call(base + ['-O', 'check', self.host], stdout=devnull, stderr=devnull) != 0:
+                    log.info("Opening master ssh connection to %s" % self.host)
+                    start = time.time()
+                    if subprocess.call(base + ['-o', 'ControlMaster=yes', '-f', '-N', self.host], stdout=devnull, stderr=devnull) == 0:
+                        self.connections += 1
+                        self.handshake_time += time.time() - start
+                    else:
+                        log.warning("Unable to open master ssh connection to %s" % self.host)
+            self.last_use = time.time()
+
+    def command(self, remote_command):
+        """ Returns the command line to run remote_command on host """
+        self.connect()
+        return 'ssh %s %s %s' % (self.options(), self.host, remote_command)
@@ -0,0 +1,65 @@
+import multiprocessing
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+from colorlog import log
+
+OUTCOMES = ['passed', 'failed', 'skipped', 'errors']
+
+
+def local_tag(element):
+    # junit files may come with a namespace
+    return element.tag.rsplit('}', 1)[-1]
+
+def parse_junit(path):
+    """ Counts the test cases of a JUnit xml file by outcome. The file is
+    parsed as a stream and every test case is discarded once counted, so
+    memory does not grow with the size of the file. Returns None if the
+    file cannot be parsed """
+    counts = dict((outcome, 0) for outcome in OUTCOMES)
+    root = None
+    try:
+        for event, element in ET.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                continue
+            if local_tag(element) != 'testcase':
+                continue
+            outcome = 'passed'
+            for child in element:
+                tag = local_tag(child)
+                if tag == 'failure':
+                    outcome = 'failed'
+                elif tag == 'error':
+                    outcome = 'errors'
+                elif tag == 'skipped' and outcome == 'passed':
+                    outcome = 'skipped'
+            counts[outcome] += 1
+            element.clear()
+            root.clear()
+    except (IOError, SyntaxError), e:
+        # ParseError is a SyntaxError
+        log.error("Unable to parse test results %s: %s" % (path, e))
+        return None
+    return counts
+
+def parse_junit_files(paths, jobs=None):
+    """ Parses many JUnit files in a pool of jobs processes, one per cpu by
+    default. Returns the counts of each file by path """
+    paths = list(paths)
+    if not paths:
+        return dict()
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(paths))
+    if jobs <= 1:
+        return dict((path, parse_junit(path)) for path in paths)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        counts = pool.map(parse_junit, paths)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(paths, counts))
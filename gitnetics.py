@@ -5,7 +5,8 @@ import argparse
 import os
 from core.colorlog import log,logsummary
 from core.polymerase import Polymerase
-import xml.etree.ElementTree as ET
+from core.repotypes.sshtransport import SSHTransport
+from core.testresults import parse_junit_files
 
 
 def projectname(project_name):
@@ -24,6 +25,7 @@ def parse_args(parser):
     parser.add_argument('-m', '--watch-method', dest='watch_method', action='store', help='upstream branch to consider')
     parser.add_argument('-w', '--watch-branches', dest='watch_branches', action='store', help='upstream branch to consider')
     parser.add_argument('--no-fetch', dest='fetch', action='store_false', help='upstream branch to consider')
+    parser.add_argument('--jobs', '-j', dest='jobs', action='store', type=int, default=1, help='number of projects to handle in parallel')
 
     subparsers = parser.add_subparsers(dest='command')
 
@@ -39,12 +41,22 @@ def parse_args(parser):
     parser_prepare_tests = subparsers.add_parser('prepare-tests')
     parser_prepare_tests.add_argument('-t','--tests-base-dir', dest='tests_basedir', action='store', required=True, help='path to the file to be generated')
     parser_prepare_tests.add_argument('-r','--recombination-id', dest='recomb_id', action='store', help='change id to handle')
+    parser_prepare_tests.add_argument('--export-mode', dest='export_mode', action='store', choices=['archive', 'worktree'], default='archive', help='how to materialize recombinations code')
+    parser_prepare_tests.add_argument('--jobs', dest='export_jobs', action='store', type=int, default=1, help='number of recombinations to export in parallel')
 
     parser_cleanup = subparsers.add_parser('cleanup')
+    parser_cleanup.add_argument('--dry-run', dest='dry_run', action='store_true', help='show the branches to delete without deleting them')
+
+    parser_daemon = subparsers.add_parser('daemon', help='handle gerrit events as they arrive', description='handle gerrit events as they arrive')
+    parser_daemon.add_argument('--events-file', dest='events_path', action='store', help='read events from this file, one json event per line, instead of gerrit stream-events; - for standard input')
+    parser_daemon.add_argument('--batch-delay', dest='batch_delay', action='store', type=float, default=None, help='seconds to wait for more events before handling them')
+    parser_daemon.add_argument('--poll-interval', dest='poll_interval', action='store', type=int, default=None, help='seconds between scans of original repositories that are not gerrit')
+    parser_daemon.add_argument('--no-initial-scan', dest='initial_scan', action='store_false', help='do not scan all projects at start')
 
     parser_vote_recombinations = subparsers.add_parser('vote-recombinations', help='Vote on Recombinations', description='poll replica')
     parser_vote_recombinations.add_argument('-r','--recombination-id', dest='recomb_id', action='store', help='change id to handle')
     parser_vote_recombinations.add_argument('-t','--tests-base-dir', dest='tests_basedir', action='store', required=True, help='path to the file to be generated')
+    parser_vote_recombinations.add_argument('--jobs', dest='parse_jobs', action='store', type=int, default=None, help='number of test results files to parse in parallel, one per cpu by default')
 
     args = parser.parse_args()
 
@@ -60,7 +72,7 @@ if __name__=="__main__":
 
     projects = yaml.load(args.projects_path.read())
     try:
-        gitnetic = Polymerase(projects, args.base_dir, filter_projects=args.projects, filter_method=args.watch_method, filter_branches=args.watch_branches, fetch=args.fetch)
+        gitnetic = Polymerase(projects, args.base_dir, filter_projects=args.projects, filter_method=args.watch_method, filter_branches=args.watch_branches, fetch=args.fetch, jobs=args.jobs)
     except ValueError:
         log.critical('No projects to handle')
         sys.exit(1)
@@ -72,7 +84,7 @@ if __name__=="__main__":
             os.makedirs(args.tests_basedir)
         except OSError:
             pass
-        tester_vars = gitnetic.prepare_tests(args.tests_basedir, recomb_id=args.recomb_id)
+        tester_vars = gitnetic.prepare_tests(args.tests_basedir, recomb_id=args.recomb_id, export_mode=args.export_mode, export_jobs=args.export_jobs)
         projects_info = tester_vars.pop('projects_conf')
         project_vars_path = "%s/project-vars.yaml" % (args.tests_basedir)
         dump(projects_info, project_vars_path)
@@ -85,6 +97,8 @@ if __name__=="__main__":
 
     if args.command == 'vote-recombinations':
         test_results = dict()
+        # results files are parsed all together at the end
+        results_files = dict()
         for root, dirs, files in os.walk(args.tests_basedir):
             if 'vars.yaml' in files:
                 with open(os.path.join(root, "vars.yaml")) as var_file:
@@ -103,11 +117,14 @@ if __name__=="__main__":
                         test_results_file = test_vars['tests'][project_name]["types"][test_type]
                         try:
                             os.stat(args.tests_basedir + "/" + test_results_file)
-                            test_results[target_project][recombination_id][project_name][test_type] = []
-                            # TODO: load test results from xml format
+                            results_files[(target_project, recombination_id, project_name, test_type)] = args.tests_basedir + "/" + test_results_file
                         except OSError:
                            test_results[target_project][recombination_id][project_name][test_type] = None
                            logsummary.error("Recombination id: %s , mIssing test result file %s" % (recombination_id, test_results_file))
+        results_counts = parse_junit_files(results_files.values(), jobs=args.parse_jobs)
+        for key in results_files:
+            target_project, recombination_id, project_name, test_type = key
+            test_results[target_project][recombination_id][project_name][test_type] = results_counts[results_files[key]]
         log.debugvar('test_results')
         if test_results:
             gitnetic.vote_recombinations(test_results, recomb_id=args.recomb_id)
@@ -124,4 +141,14 @@ if __name__=="__main__":
         gitnetic.poll_original()
 
     elif args.command == 'cleanup':
-        gitnetic.janitor()
+        gitnetic.janitor(dry_run=args.dry_run)
+
+    elif args.command == 'daemon':
+        try:
+            gitnetic.serve(events_path=args.events_path, batch_delay=args.batch_delay, poll_interval=args.poll_interval, initial_scan=args.initial_scan)
+        except KeyboardInterrupt:
+            logsummary.info("Daemon interrupted")
+
+    transport_metrics = SSHTransport.metrics()
+    for host in transport_metrics:
+        logsummary.info("ssh %s: %d commands over %d connections, %.2fs spent in handshakes" % (host, transport_metrics[host]['commands'], transport_metrics[host]['connections'], transport_metrics[host]['handshake-time']))
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from core.colorlog import log, logsummary
+from core.daemon import Daemon, FileEventSource
+from core.project import Project
+
+
+class StubUnderlayer(object):
+
+    branch_maps = {
+        'original->replica': {'master': 'master'},
+        'original->target': {'master': 'master-tag'},
+        'original->patches': {'master': 'master-patches'},
+    }
+
+
+class StubProject(Project):
+    """ A project that records the scans it is asked to run """
+
+    def __init__(self):
+        self.original_branches = ['master']
+        self.underlayer = StubUnderlayer()
+        self.scans = list()
+
+    def run_scans(self, scans):
+        self.scans.append(sorted(scans))
+
+
+class StubPolymerase(object):
+
+    def __init__(self):
+        self.projects = {'nova': StubProject(), 'xinetd': StubProject()}
+        self.projects_infos = {
+            'nova': {
+                'original': {'type': 'gerrit', 'location': 'upstream', 'name': 'openstack/nova'},
+                'replica': {'type': 'gerrit', 'location': 'replica', 'name': 'nova-gitnetics'},
+            },
+            'xinetd': {
+                'original': {'type': 'git', 'location': 'github', 'name': 'xinetd-org/xinetd'},
+                'replica': {'type': 'gerrit', 'location': 'replica', 'name': 'xinetd'},
+            },
+        }
+
+    def run_projects(self, step, *args, **kwargs):
+        for project_name in kwargs['project_names']:
+            step(project_name, self.projects[project_name], *args)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_levels = log.level, logsummary.level
+        log.setLevel(logging.CRITICAL)
+        logsummary.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        log.setLevel(self.log_levels[0])
+        logsummary.setLevel(self.log_levels[1])
+        shutil.rmtree(self.directory)
+
+    def run_daemon(self, events, lines=()):
+        path = os.path.join(self.directory, 'events')
+        with open(path, 'w') as events_file:
+            for event in events:
+                events_file.write(json.dumps(event) + '\n')
+            for line in lines:
+                events_file.write(line + '\n')
+        polymerase = StubPolymerase()
+        # events are handled in a single batch when the file ends
+        daemon = Daemon(polymerase, [FileEventSource(path)], batch_delay=60, poll_interval=3600)
+        daemon.run(initial_scan=False)
+        return dict((project_name, project.scans) for project_name, project in polymerase.projects.items())
+
+    def test_duplicates_coalesced(self):
+        merged = {'type': 'ref-updated', 'refUpdate': {'project': 'openstack/nova', 'refName': 'refs/heads/master'}}
+        patches = {'type': 'patchset-created', 'change': {'project': 'nova-gitnetics', 'branch': 'master-patches'}}
+        scans = self.run_daemon([merged, patches, merged, dict(merged, host='upstream'), patches])
+        self.assertEqual(scans['nova'], [[('original', 'master'), ('patches', 'master-patches')]])
+        self.assertEqual(scans['xinetd'], [])
+
+    def test_ignored_events(self):
+        scans = self.run_daemon([
+            # changes refs
+            {'type': 'ref-updated', 'refUpdate': {'project': 'openstack/nova', 'refName': 'refs/changes/01/1/1'}},
+            # unwatched branch
+            {'type': 'change-merged', 'change': {'project': 'openstack/nova', 'branch': 'stable/x'}},
+            # other gerrit host
+            {'type': 'comment-added', 'host': 'other', 'change': {'project': 'xinetd', 'branch': 'master-patches'}},
+            # not stream events of interest
+            {'type': 'reviewer-added', 'change': {'project': 'xinetd', 'branch': 'master-patches'}},
+        ])
+        self.assertEqual(scans, {'nova': [], 'xinetd': []})
+
+    def test_malformed_events(self):
+        scans = self.run_daemon([
+            {'type': 'ref-updated'},
+            {'type': 'ref-updated', 'refUpdate': {'refName': 'refs/heads/master'}},
+            {'type': 'patchset-created', 'change': {'project': 'xinetd'}},
+            {'type': 'patchset-created', 'change': None},
+            [],
+            {'type': 'patchset-created', 'change': {'project': 'xinetd', 'branch': 'master-patches'}},
+        ], lines=['not json'])
+        self.assertEqual(scans['xinetd'], [[('patches', 'master-patches')]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import json
+import logging
+import socket
+import threading
+import unittest
+import urlparse
+
+from core.colorlog import log
+from core.exceptions import QueryError
+from core.repotypes.gerritrest import GerritREST
+
+
+def rest_change(number):
+    """ A ChangeInfo as gerrit returns it with the query options of
+    GerritREST """
+    revision = '%040x' % number
+    return {
+        'change_id': 'I%040d' % number,
+        '_number': number,
+        'project': 'nova-gitnetics',
+        'branch': 'master',
+        'status': 'NEW',
+        'topic': 'topic-%d' % number,
+        'updated': '2016-03-01 10:00:%02d.000000000' % number,
+        'messages': [
+            {'date': '2016-03-01 09:00:00.000000000', 'author': {'username': 'jenkins'}, 'message': 'Patch Set 1: Verified+1'},
+        ],
+        'labels': {
+            'Code-Review': {'all': [{'value': 2, 'username': 'core'}, {'value': 0, 'username': 'other'}]},
+            'Verified': {'all': [{'value': 1, 'username': 'jenkins'}]},
+        },
+        'current_revision': revision,
+        'revisions': {
+            revision: {
+                '_number': 3,
+                'commit': {'message': 'change %d\n' % number, 'parents': [{'commit': '%040x' % 0}]},
+            },
+        },
+    }
+
+
+class StubGerritHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers queries from the changes of the server, a page at a time,
+    and records every request """
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, data):
+        content = ")]}'\n" + json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(url.query)
+        self.server.requests.append(('GET', url.path, params))
+        if self.server.fail:
+            self.send_json(500, 'internal error')
+            return
+        start = int(params.get('S', ['0'])[0])
+        count = int(params['n'][0])
+        changes = self.server.changes[start:start + count]
+        if changes and start + count < len(self.server.changes):
+            changes[-1] = dict(changes[-1], _more_changes=True)
+        self.send_json(200, changes)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.server.requests.append(('POST', self.path, json.loads(body)))
+        self.send_json(200, dict())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestGerritREST(unittest.TestCase):
+
+    def setUp(self):
+        self.log_level = log.level
+        log.setLevel(logging.CRITICAL)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubGerritHandler)
+        self.server.changes = [rest_change(number) for number in range(1, 6)]
+        self.server.requests = list()
+        self.server.fail = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.remote = GerritREST('replica', 'localhost', 'nova-gitnetics', 'http://127.0.0.1:%d/' % self.server.server_port)
+        self.remote.page_size = 2
+
+    def tearDown(self):
+        # the server handles a single keep-alive connection at a time
+        if self.remote.connection is not None:
+            self.remote.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        log.setLevel(self.log_level)
+
+    def test_pagination(self):
+        changes = self.remote.query_changes_json("'project:nova-gitnetics AND status:open'")
+        self.assertEqual([infos['number'] for infos in changes], ['1', '2', '3', '4', '5'])
+        self.assertEqual([params['S'] for method, path, params in self.server.requests], [['0'], ['2'], ['4']])
+        # shell quoting is removed
+        self.assertEqual(self.server.requests[0][2]['q'], ['project:nova-gitnetics AND status:open'])
+
+    def test_limit(self):
+        changes = self.remote.query_changes_json('status:open', limit=2)
+        self.assertEqual([infos['number'] for infos in changes], ['1', '2'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_results(self):
+        self.server.changes = list()
+        self.assertEqual(self.remote.query_changes_json('status:open'), list())
+
+    def test_failed_query(self):
+        self.server.fail = True
+        self.assertRaises(QueryError, self.remote.query_changes_json, 'status:open')
+
+    def test_unreachable_server(self):
+        # a port nobody listens on
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        remote = GerritREST('replica', 'localhost', 'nova-gitnetics', 'http://127.0.0.1:%d/' % port)
+        self.assertRaises(QueryError, remote.query_changes_json, 'status:open')
+        self.assertFalse(remote.review_change(1, 1, {'message': 'lost'}))
+
+    def test_non_ascii_query(self):
+        self.remote.query_changes_json(u'message:"café"')
+        self.assertEqual(self.server.requests[0][2]['q'], ['message:café'])
+
+    def test_ssh_infos(self):
+        infos = self.remote.query_changes_json('change:1', limit=1)[0]
+        self.assertEqual(infos['id'], 'I%040d' % 1)
+        self.assertEqual(infos['number'], '1')
+        self.assertEqual(infos['topic'], 'topic-1')
+        self.assertEqual(infos['url'], 'http://127.0.0.1:%d/1' % self.server.server_port)
+        self.assertEqual(infos['lastUpdated'], 1456826401)
+        self.assertEqual(infos['commitMessage'], 'change 1\n')
+        self.assertEqual(infos['comments'], [{'timestamp': 1456822800, 'reviewer': {'username': 'jenkins'}, 'message': 'Patch Set 1: Verified+1'}])
+        patchset = infos['currentPatchSet']
+        self.assertEqual(patchset['number'], '3')
+        self.assertEqual(patchset['revision'], '%040x' % 1)
+        self.assertEqual(patchset['parents'], ['%040x' % 0])
+        # votes of 0 are not approvals
+        self.assertEqual(sorted((approval['type'], approval['value']) for approval in patchset['approvals']),
+                         [('Code-Review', '2'), ('Verified', '1')])
+
+    def test_review_changes(self):
+        results = self.remote.review_changes([(1, 3, {'message': 'first'}), (2, 1, {'message': 'second'})])
+        self.assertEqual(results, {1: True, 2: True})
+        self.assertEqual([request[1:] for request in self.server.requests],
+                         [('/changes/1/revisions/3/review', {'message': 'first'}),
+                          ('/changes/2/revisions/1/review', {'message': 'second'})])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import logging
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from core.colorlog import log
+from core.repotypes.git import Git
+
+
+class TestReadCommits(unittest.TestCase):
+
+    def setUp(self):
+        self.log_level = log.level
+        log.setLevel(logging.CRITICAL)
+        self.directory = tempfile.mkdtemp()
+        self.git('init', '-q', '.')
+        self.commit('base')
+        self.git('branch', 'base')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        log.setLevel(self.log_level)
+
+    def git(self, *args):
+        command = ['git', '-c', 'user.name=test', '-c', 'user.email=test@localhost'] + list(args)
+        return subprocess.check_output(command, cwd=self.directory).strip()
+
+    def commit(self, message):
+        self.git('commit', '-q', '--allow-empty', '--allow-empty-message', '-m', message)
+        return self.git('rev-parse', 'HEAD')
+
+    def test_bodies(self):
+        first = self.commit('first\n\nbody line\n\nChange-Id: I1')
+        empty = self.commit('')
+        last = self.commit('last')
+        commits = Git(self.directory).read_commits('base', 'HEAD')
+        self.assertEqual([commit['hash'] for commit in commits], [first, empty, last])
+        self.assertEqual([commit['body'] for commit in commits], [['first', 'body line', 'Change-Id: I1'], [], ['last']])
+        self.assertEqual([commit['parents'] for commit in commits], [[self.git('rev-parse', 'base')], [first], [empty]])
+
+    def test_root_commit(self):
+        self.git('checkout', '-q', '--orphan', 'side')
+        root = self.commit('root\n\nChange-Id: I2')
+        self.git('checkout', '-q', 'master')
+        self.git('merge', '-q', '--allow-unrelated-histories', '-m', 'merge', 'side')
+        commits = Git(self.directory).read_commits('base', 'master')
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(commits[0]['body'], ['merge'])
+        subcommits = commits[0]['subcommits']
+        self.assertEqual([commit['hash'] for commit in subcommits], [root])
+        self.assertEqual(subcommits[0]['parents'], [])
+        self.assertEqual(subcommits[0]['body'], ['root', 'Change-Id: I2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import logging
+import StringIO
+import sys
+import threading
+import time
+import unittest
+
+from core.colorlog import log, logsummary
+from core.polymerase import Polymerase
+
+
+class RecordsHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordsHandler, self).__init__()
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestForeachProject(unittest.TestCase):
+
+    project_names = ['alpha', 'beta', 'gamma', 'delta']
+
+    def setUp(self):
+        self.handler = RecordsHandler()
+        self.handlers = logsummary.handlers
+        logsummary.handlers = [self.handler]
+        self.log_level = log.level
+        log.setLevel(logging.CRITICAL)
+        # tracebacks of failed projects
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.polymerase = Polymerase.__new__(Polymerase)
+        self.polymerase.projects = dict((project_name, None) for project_name in self.project_names)
+        self.polymerase.projects_infos = dict((project_name, dict()) for project_name in self.project_names)
+
+    def tearDown(self):
+        logsummary.handlers = self.handlers
+        log.setLevel(self.log_level)
+        sys.stdout = self.stdout
+
+    def step(self, project_name, project, lines=3):
+        for line in range(lines):
+            logsummary.info("%s %d" % (project_name, line))
+            # give the other projects a chance to log meanwhile
+            time.sleep(0.01)
+        if project_name == 'gamma':
+            raise ValueError("broken project")
+        return threading.current_thread().name
+
+    def test_summary_grouped_by_project(self):
+        self.polymerase.jobs = 3
+        results = self.polymerase.run_projects(self.step, lines=5)
+        self.assertEqual(sorted(results), sorted(self.project_names))
+        self.assertEqual(results['gamma'], None)
+        # projects ran in parallel
+        self.assertTrue(len(set(results[project_name] for project_name in results if results[project_name])) > 1)
+
+        blocks = list()
+        for record in self.handler.records:
+            words = record.getMessage().split()
+            if words[0] == 'Project':
+                project_name = words[1]
+            else:
+                project_name = words[0]
+            if not blocks or blocks[-1][0] != project_name:
+                blocks.append((project_name, list()))
+            blocks[-1][1].append(record.getMessage())
+        self.assertEqual(sorted(block[0] for block in blocks), sorted(self.project_names))
+        for project_name, messages in blocks:
+            expected = ["%s %d" % (project_name, line) for line in range(5)]
+            if project_name == 'gamma':
+                expected.append("Project gamma skipped, reason: broken project")
+            self.assertEqual(messages, expected)
+
+    def test_serial_not_grouped(self):
+        self.polymerase.jobs = 1
+        results = self.polymerase.run_projects(self.step, project_names=['alpha', 'beta'])
+        self.assertEqual(sorted(results), ['alpha', 'beta'])
+        self.assertEqual([record.getMessage() for record in self.handler.records],
+                         ['alpha 0', 'alpha 1', 'alpha 2', 'beta 0', 'beta 1', 'beta 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
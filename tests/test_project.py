@@ -0,0 +1,75 @@
+import logging
+import unittest
+
+from core.colorlog import log, logsummary
+from core.project import Project
+
+
+class StubRemote(object):
+
+    def updated_since(self, timestamp):
+        return False
+
+
+class StubUnderlayer(object):
+
+    branch_maps = {
+        'original->replica': {'master': 'master'},
+        'original->target': {'master': 'master-tag'},
+        'original->patches': {'master': 'master-patches'},
+    }
+
+    def __init__(self):
+        self.replica_remote = StubRemote()
+        self.state = dict()
+
+    def get_revision(self, ref):
+        return 'head of %s' % ref
+
+    def load_state(self, name):
+        return self.state.get(name)
+
+    def save_state(self, name, data):
+        self.state[name] = data
+
+
+class IdleProject(Project):
+    """ A project whose original branch has no new commits """
+
+    def __init__(self):
+        self.project_info = dict()
+        self.original_branches = ['master']
+        self.recombinations = dict()
+        self.underlayer = StubUnderlayer()
+        self.intervals = 0
+
+    def get_recombinations_by_interval(self, original_branch):
+        self.intervals += 1
+        return None
+
+
+class TestScanOriginalDistance(unittest.TestCase):
+
+    def setUp(self):
+        self.log_levels = log.level, logsummary.level
+        log.setLevel(logging.CRITICAL)
+        logsummary.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        log.setLevel(self.log_levels[0])
+        logsummary.setLevel(self.log_levels[1])
+
+    def test_no_new_commits(self):
+        project = IdleProject()
+        self.assertTrue(project.scan_original_distance('master'))
+        self.assertEqual(project.recombinations['master'], None)
+
+    def test_idle_poll_skipped(self):
+        project = IdleProject()
+        self.assertFalse(project.poll_original_branches())
+        self.assertTrue(project.poll_original_branches())
+        self.assertEqual(project.intervals, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
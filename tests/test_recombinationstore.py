@@ -0,0 +1,70 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from core.colorlog import log
+from core.exceptions import QueryError
+from core.repotypes.recombinationstore import RecombinationStore
+
+
+class StubRepo(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def state_path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class StubRemote(object):
+    """ A gerrit without recombinations, that can fail queries """
+
+    name = 'replica'
+
+    def __init__(self):
+        self.fail = False
+        self.queried = list()
+
+    def get_updated_changes_infos(self, since):
+        return list()
+
+    def get_changes_infos(self, values, search_field='change', search_abandoned=False):
+        if self.fail:
+            raise QueryError("gerrit is unreachable")
+        self.queried.append(list(values))
+        return list()
+
+
+class TestRecombinationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.log_level = log.level
+        log.setLevel(logging.CRITICAL)
+        self.directory = tempfile.mkdtemp()
+        self.store = RecombinationStore(StubRepo(self.directory))
+        self.remote = StubRemote()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+        log.setLevel(self.log_level)
+
+    def test_missing_topics_queried_once(self):
+        self.assertEqual(self.store.get_changes_data(self.remote, ['topic-1']), dict())
+        self.assertEqual(self.store.get_changes_data(self.remote, ['topic-1', 'topic-2']), dict())
+        self.assertEqual(self.remote.queried, [['topic-1'], ['topic-2']])
+
+    def test_failed_query_rolled_back(self):
+        self.remote.fail = True
+        self.assertRaises(QueryError, self.store.get_changes_data, self.remote, ['topic-1'])
+        self.remote.fail = False
+        # a later commit on the same connection
+        self.store.get_changes_data(self.remote, ['topic-2'])
+        self.store.get_changes_data(self.remote, ['topic-1'])
+        self.assertEqual(self.remote.queried, [['topic-2'], ['topic-1']])
+
+
+if __name__ == '__main__':
+    unittest.main()
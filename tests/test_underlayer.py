@@ -0,0 +1,68 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from core.colorlog import log
+from core.repotypes.git import Underlayer
+
+
+class TestUnderlayerThreads(unittest.TestCase):
+    """ Underlayers of different projects used at the same time from
+    different threads """
+
+    def setUp(self):
+        self.log_level = log.level
+        log.setLevel(logging.CRITICAL)
+        self.directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        for index, directory in enumerate(self.directories):
+            self.git(directory, 'init', '-q', '.')
+            self.git(directory, 'commit', '-q', '--allow-empty', '-m', 'base')
+            self.git(directory, 'branch', 'base')
+            # histories of different lengths and contents
+            for number in range(5 + index * 7):
+                self.git(directory, 'commit', '-q', '--allow-empty', '-m', 'repo %d change %d' % (index, number))
+
+    def tearDown(self):
+        for directory in self.directories:
+            shutil.rmtree(directory)
+        log.setLevel(self.log_level)
+
+    def git(self, directory, *args):
+        command = ['git', '-c', 'user.name=test', '-c', 'user.email=test@localhost'] + list(args)
+        return subprocess.check_output(command, cwd=directory).strip()
+
+    def test_concurrent_underlayers(self):
+        cwd = os.getcwd()
+        expected = dict()
+        for directory in self.directories:
+            expected[directory] = (self.git(directory, 'rev-parse', 'master'), self.git(directory, 'rev-list', '--reverse', 'base..master').split())
+        results = dict((directory, list()) for directory in self.directories)
+        errors = list()
+
+        def work(directory):
+            try:
+                underlayer = Underlayer('project', directory)
+                for attempt in range(10):
+                    commits = underlayer.get_commits('base', 'master')
+                    results[directory].append((underlayer.get_revision('master'), [commit['hash'] for commit in commits]))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(directory,)) for directory in self.directories]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, list())
+        for directory in self.directories:
+            self.assertEqual(results[directory], [expected[directory]] * 10)
+        self.assertEqual(os.getcwd(), cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()